@@ -0,0 +1,98 @@
+"""
+Compares the write-behind KVWrapper against the old SqliteDict wrapper, which
+committed on every write.
+
+Several processes, like Sanic workers, share one KV file. Each runs a mix of
+`put` and `get` calls on its own keys and the aggregate throughput is
+reported. The old wrapper needs `pip install sqlitedict`.
+
+    python bench/bench_kv.py --processes 4 --ops 2000 --write-ratio 0.5
+"""
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import search4all  # noqa: E402
+
+
+class SqliteDictKVWrapper(object):
+    """ The KVWrapper before the write-behind store. """
+    def __init__(self, kv_name):
+        from sqlitedict import SqliteDict
+
+        self._db = SqliteDict(filename=kv_name)
+
+    def get(self, key: str):
+        v = self._db[key]
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    def put(self, key: str, value):
+        self._db[key] = value
+        self._db.commit()
+
+    def close(self):
+        self._db.close()
+
+
+def worker(kind, filename, worker_id, ops, write_ratio, payload_size, results):
+    kv = SqliteDictKVWrapper(filename) if kind == "sqlitedict" else search4all.KVWrapper(filename)
+    rng = random.Random(worker_id)
+    payload = {"query": "q", "txt": "x" * payload_size}
+    written = []
+    start = time.perf_counter()
+    for i in range(ops):
+        if not written or rng.random() < write_ratio:
+            key = f"{worker_id}-{i}"
+            kv.put(key, payload)
+            written.append(key)
+        else:
+            kv.get(rng.choice(written))
+    kv.close()
+    results.put(time.perf_counter() - start)
+
+
+def run(kind, args):
+    with tempfile.TemporaryDirectory() as tmp:
+        filename = os.path.join(tmp, "bench.db")
+        # Create the file up front, so that the workers do not race on it.
+        kv = SqliteDictKVWrapper(filename) if kind == "sqlitedict" else search4all.KVWrapper(filename)
+        kv.close()
+        results = multiprocessing.Queue()
+        processes = [
+            multiprocessing.Process(
+                target=worker,
+                args=(kind, filename, i, args.ops, args.write_ratio, args.payload_size, results),
+            )
+            for i in range(args.processes)
+        ]
+        start = time.perf_counter()
+        for p in processes:
+            p.start()
+        for p in processes:
+            p.join()
+        elapsed = time.perf_counter() - start
+        slowest = max(results.get() for _ in processes)
+    total = args.processes * args.ops
+    print(f"{kind:<12} {total / elapsed:10.0f} ops/s  (slowest worker {slowest:.2f} s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--processes", type=int, default=4)
+    parser.add_argument("--ops", type=int, default=2000, help="operations per process")
+    parser.add_argument("--write-ratio", type=float, default=0.5)
+    parser.add_argument("--payload-size", type=int, default=8000, help="bytes of txt per entry")
+    args = parser.parse_args()
+    run("sqlitedict", args)
+    run("write-behind", args)
+
+
+if __name__ == "__main__":
+    main()
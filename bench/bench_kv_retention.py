@@ -0,0 +1,103 @@
+"""
+Reports what the compressed KV storage saves, and the lookup latency of a
+large store.
+
+The store is filled with `--entries` answers shaped like the ones query_function
+writes: the JSON-dumped contexts, the __LLM_RESPONSE__ marker, the answer and
+the related questions. It is built once uncompressed and once compressed. The
+file sizes are compared, then random keys are read to measure the p50 and p99
+lookup latency. Use `--entries 300000` or more to get a multi-GB
+uncompressed store.
+
+    python bench/bench_kv_retention.py --entries 50000 --lookups 20000
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import search4all  # noqa: E402
+
+WORDS = (
+    "the of and to in is was for on that with as by at from his her an which or are "
+    "search engine answer question model language history city river science music "
+    "university government population century war world state north south company "
+    "released series first second new time year people known called used including"
+).split()
+
+
+def fake_answer(rng):
+    def sentence(n):
+        return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+    contexts = [
+        {
+            "name": sentence(6),
+            "url": f"https://example{rng.randrange(1000)}.com/{rng.randrange(10**6)}",
+            "snippet": " ".join(sentence(15) for _ in range(3)),
+        }
+        for _ in range(search4all.REFERENCE_COUNT)
+    ]
+    answer = " ".join(f"{sentence(18)}[citation:{rng.randrange(1, 9)}]" for _ in range(12))
+    related = [{"question": sentence(10)} for _ in range(3)]
+    return (
+        json.dumps(contexts)
+        + "\n\n__LLM_RESPONSE__\n\n"
+        + answer
+        + "\n\n__RELATED_QUESTIONS__\n\n"
+        + json.dumps(related)
+    )
+
+
+def build(filename, entries, compress_min_bytes):
+    kv = search4all.KVWrapper(filename, compress_min_bytes=compress_min_bytes)
+    rng = random.Random(0)
+    for i in range(entries):
+        kv.put(f"uuid-{i}", {"query": f"query {i}", "txt": fake_answer(rng)})
+        if i % 5000 == 4999:
+            kv.flush()
+    kv.close()
+    return os.path.getsize(filename)
+
+
+def lookups(filename, entries, count):
+    kv = search4all.KVWrapper(filename)
+    rng = random.Random(1)
+    latencies = []
+    for _ in range(count):
+        key = f"uuid-{rng.randrange(entries)}"
+        start = time.perf_counter()
+        kv.get(key)
+        latencies.append(time.perf_counter() - start)
+    kv.close()
+    latencies.sort()
+    return latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99) - 1]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--entries", type=int, default=50000)
+    parser.add_argument("--lookups", type=int, default=20000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        raw = os.path.join(tmp, "raw.db")
+        compressed = os.path.join(tmp, "compressed.db")
+        raw_size = build(raw, args.entries, compress_min_bytes=float("inf"))
+        compressed_size = build(compressed, args.entries, compress_min_bytes=None)
+        print(f"uncompressed {raw_size / 2**20:10.1f} MiB")
+        print(
+            f"compressed   {compressed_size / 2**20:10.1f} MiB"
+            f"  ({100 * (1 - compressed_size / raw_size):.0f}% saved)"
+        )
+        for name, filename in (("uncompressed", raw), ("compressed", compressed)):
+            p50, p99 = lookups(filename, args.entries, args.lookups)
+            print(f"{name:<12} lookup p50 {p50 * 1e6:8.0f} us  p99 {p99 * 1e6:8.0f} us")
+
+
+if __name__ == "__main__":
+    main()
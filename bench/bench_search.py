@@ -0,0 +1,152 @@
+"""
+Compares the async, pooled search path against the old executor path.
+
+A local stub search server answers with a Bing-shaped payload after a fixed
+delay. The old path runs a blocking `requests.get` per query on a thread pool
+(a fresh connection every time), the new path awaits `search_with_bing` on one
+shared `httpx.AsyncClient`.
+
+    python bench/bench_search.py --queries 500 --concurrency 64 --delay 0.05
+"""
+import argparse
+import asyncio
+import concurrent.futures
+import json
+import os
+import statistics
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import httpx
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("BACKEND", "BING")
+import search4all  # noqa: E402
+
+
+def make_stub_handler(delay):
+    payload = json.dumps(
+        {
+            "webPages": {
+                "value": [
+                    {
+                        "name": f"Result {i}",
+                        "url": f"https://example.com/{i}",
+                        "snippet": "Lorem ipsum dolor sit amet. " * 8,
+                    }
+                    for i in range(10)
+                ]
+            }
+        }
+    ).encode()
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_GET(self):
+            time.sleep(delay)
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def log_message(self, *args):
+            pass
+
+    return StubHandler
+
+
+def legacy_search(url, query):
+    response = requests.get(
+        url,
+        headers={"Ocp-Apim-Subscription-Key": "bench"},
+        params={"q": query, "mkt": search4all.BING_MKT},
+        timeout=search4all.DEFAULT_SEARCH_ENGINE_TIMEOUT,
+    )
+    return response.json()["webPages"]["value"][: search4all.REFERENCE_COUNT]
+
+
+async def run_executor_path(url, queries, concurrency):
+    loop = asyncio.get_running_loop()
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=concurrency)
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await loop.run_in_executor(executor, legacy_search, url, f"query {i}")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(queries)])
+    elapsed = time.perf_counter() - start
+    executor.shutdown()
+    return elapsed, latencies
+
+
+async def run_async_path(url, queries, concurrency):
+    search4all.BING_SEARCH_V7_ENDPOINT = url
+    client = httpx.AsyncClient(
+        limits=httpx.Limits(
+            max_connections=search4all.HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=search4all.HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=search4all.HTTP_KEEPALIVE_EXPIRY,
+        ),
+    )
+    semaphore = asyncio.Semaphore(concurrency)
+    latencies = []
+
+    async def one(i):
+        async with semaphore:
+            start = time.perf_counter()
+            await search4all.search_with_bing(client, f"query {i}", "bench")
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*[one(i) for i in range(queries)])
+    elapsed = time.perf_counter() - start
+    await client.aclose()
+    return elapsed, latencies
+
+
+def report(name, queries, elapsed, latencies):
+    latencies = sorted(latencies)
+    p95 = latencies[int(len(latencies) * 0.95) - 1]
+    print(
+        f"{name:<10} {queries / elapsed:8.1f} q/s  "
+        f"p50 {statistics.median(latencies) * 1000:7.1f} ms  "
+        f"p95 {p95 * 1000:7.1f} ms"
+    )
+
+
+class StubServer(ThreadingHTTPServer):
+    """ Accepts a load test's burst of connections instead of resetting them. """
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--queries", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--delay", type=float, default=0.05, help="stub latency in seconds")
+    args = parser.parse_args()
+
+    server = StubServer(("127.0.0.1", 0), make_stub_handler(args.delay))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/v7.0/search"
+
+    elapsed, latencies = asyncio.run(run_executor_path(url, args.queries, args.concurrency))
+    report("executor", args.queries, elapsed, latencies)
+    elapsed, latencies = asyncio.run(run_async_path(url, args.queries, args.concurrency))
+    report("async", args.queries, elapsed, latencies)
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
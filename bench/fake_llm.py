@@ -0,0 +1,196 @@
+"""
+A local fake LLM server that streams answers like the OpenAI and the
+Anthropic APIs, with a configurable time to first token and token rate.
+
+    python bench/fake_llm.py --port 8802 --ttft 0.5 --tokens-per-second 50
+    OPENAI_BASE_URL=http://127.0.0.1:8802/v1 OPENAI_API_KEY=bench LLM_MODEL=gpt-bench python search4all.py
+    ANTHROPIC_BASE_URL=http://127.0.0.1:8802 ANTHROPIC_API_KEY=bench LLM_MODEL=claude-3-bench python search4all.py
+
+Streamed calls get `--tokens` tokens with citations; the other calls are the
+related questions tool calls, answered after the time to first token.
+"""
+import argparse
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+QUESTIONS = [
+    "What is the history of this topic?",
+    "How does it compare to the alternatives?",
+    "What are the latest developments?",
+]
+
+
+def answer_tokens(count):
+    for i in range(count):
+        if i % 20 == 19:
+            yield f"[[citation:{i // 20 % 8 + 1}]] "
+        else:
+            yield f"word{i} "
+
+
+def make_handler(args):
+    class FakeLLMHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _json(self, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(200)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _start_stream(self):
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Transfer-Encoding", "chunked")
+            self.end_headers()
+
+        def _send(self, data: str):
+            data = data.encode()
+            self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+            self.wfile.flush()
+
+        def _end_stream(self):
+            self.wfile.write(b"0\r\n\r\n")
+            self.wfile.flush()
+
+        def _tokens(self):
+            time.sleep(args.ttft)
+            for token in answer_tokens(args.tokens):
+                yield token
+                time.sleep(1 / args.tokens_per_second)
+
+        def _openai(self, body):
+            if not body.get("stream"):
+                time.sleep(args.ttft)
+                self._json({
+                    "id": "chatcmpl-bench", "object": "chat.completion", "created": 0,
+                    "model": body["model"],
+                    "choices": [{
+                        "index": 0, "finish_reason": "tool_calls",
+                        "message": {"role": "assistant", "content": None, "tool_calls": [{
+                            "id": "call_bench", "type": "function",
+                            "function": {
+                                "name": "ask_related_questions",
+                                "arguments": json.dumps({"questions": QUESTIONS}),
+                            },
+                        }]},
+                    }],
+                })
+                return
+            self._start_stream()
+
+            def chunk(delta, finish_reason=None):
+                return "data: " + json.dumps({
+                    "id": "chatcmpl-bench", "object": "chat.completion.chunk", "created": 0,
+                    "model": body["model"],
+                    "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+                }) + "\n\n"
+
+            for token in self._tokens():
+                self._send(chunk({"content": token}))
+            self._send(chunk({}, "stop"))
+            self._send("data: [DONE]\n\n")
+            self._end_stream()
+
+        def _anthropic(self, body):
+            if not body.get("stream"):
+                time.sleep(args.ttft)
+                self._json({
+                    "id": "msg_bench", "type": "message", "role": "assistant",
+                    "model": body["model"], "stop_reason": "tool_use", "stop_sequence": None,
+                    "usage": {"input_tokens": 0, "output_tokens": 0},
+                    "content": [{
+                        "type": "tool_use", "id": "toolu_bench", "name": "ask_related_questions",
+                        "input": {"questions": QUESTIONS},
+                    }],
+                })
+                return
+            self._start_stream()
+
+            def event(name, data):
+                return f"event: {name}\ndata: {json.dumps(dict(data, type=name))}\n\n"
+
+            self._send(event("message_start", {"message": {
+                "id": "msg_bench", "type": "message", "role": "assistant", "content": [],
+                "model": body["model"], "stop_reason": None, "stop_sequence": None,
+                "usage": {"input_tokens": 0, "output_tokens": 0},
+            }}))
+            self._send(event("content_block_start", {
+                "index": 0, "content_block": {"type": "text", "text": ""},
+            }))
+            for token in self._tokens():
+                self._send(event("content_block_delta", {
+                    "index": 0, "delta": {"type": "text_delta", "text": token},
+                }))
+            self._send(event("content_block_stop", {"index": 0}))
+            self._send(event("message_delta", {
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": args.tokens},
+            }))
+            self._send(event("message_stop", {}))
+            self._end_stream()
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            path = urlparse(self.path).path
+            try:
+                if path.endswith("/chat/completions"):
+                    self._openai(body)
+                elif path.endswith("/messages"):
+                    self._anthropic(body)
+                else:
+                    self.send_error(404)
+            except (BrokenPipeError, ConnectionResetError):
+                # The client went away, e.g. the generation was cancelled.
+                pass
+
+        def do_HEAD(self):
+            # The warm up of the LLM clients.
+            self.send_response(200)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        def log_message(self, *args):
+            pass
+
+    return FakeLLMHandler
+
+
+class StubServer(ThreadingHTTPServer):
+    """ Accepts a load test's burst of connections instead of resetting them. """
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve(host, port, args):
+    """ Starts the fake LLM server in a thread and returns the server. """
+    server = StubServer((host, port), make_handler(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--ttft", type=float, default=0.5, help="seconds to the first token")
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--tokens", type=int, default=200, help="tokens per answer")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8802)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args)
+    print(f"Fake LLM server on http://{args.host}:{server.server_address[1]}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
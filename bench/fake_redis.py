@@ -0,0 +1,123 @@
+"""
+A local in-memory stand-in for a Redis server, speaking enough of the RESP
+protocol for KV_BACKEND=REDIS: PING, AUTH, SELECT, GET, SET (EX/PX), MGET,
+RPUSH, LRANGE and EXPIRE.
+
+    python bench/fake_redis.py --port 6390
+    KV_BACKEND=REDIS REDIS_URL=redis://127.0.0.1:6390/0 python search4all.py
+"""
+import argparse
+import asyncio
+import time
+
+
+class FakeRedis(object):
+    def __init__(self):
+        self._data = {}
+        self._expires = {}
+
+    def _alive(self, key):
+        expires_at = self._expires.get(key)
+        if expires_at is not None and expires_at < time.time():
+            self._data.pop(key, None)
+            self._expires.pop(key, None)
+        return key in self._data
+
+    def execute(self, command, args):
+        if command == b"PING":
+            return "PONG"
+        if command in (b"AUTH", b"SELECT"):
+            return "OK"
+        if command == b"GET":
+            return self._data[args[0]] if self._alive(args[0]) else None
+        if command == b"MGET":
+            return [self._data[k] if self._alive(k) else None for k in args]
+        if command == b"SET":
+            key, value = args[0], args[1]
+            self._data[key] = value
+            self._expires.pop(key, None)
+            options = [a.upper() for a in args[2:]]
+            if b"EX" in options:
+                self._expires[key] = time.time() + int(args[2 + options.index(b"EX") + 1])
+            if b"PX" in options:
+                self._expires[key] = time.time() + int(args[2 + options.index(b"PX") + 1]) / 1000
+            return "OK"
+        if command == b"RPUSH":
+            self._alive(args[0])
+            items = self._data.setdefault(args[0], [])
+            items.extend(args[1:])
+            return len(items)
+        if command == b"LRANGE":
+            items = self._data.get(args[0], []) if self._alive(args[0]) else []
+            start, stop = int(args[1]), int(args[2])
+            stop = len(items) if stop == -1 else stop + 1
+            return items[start:stop] if start >= 0 else items[max(len(items) + start, 0):stop]
+        if command == b"EXPIRE":
+            if not self._alive(args[0]):
+                return 0
+            self._expires[args[0]] = time.time() + int(args[1])
+            return 1
+        raise ValueError(f"unknown command '{command.decode()}'")
+
+
+def encode(reply) -> bytes:
+    if reply is None:
+        return b"$-1\r\n"
+    if isinstance(reply, str):
+        return f"+{reply}\r\n".encode()
+    if isinstance(reply, int):
+        return f":{reply}\r\n".encode()
+    if isinstance(reply, bytes):
+        return f"${len(reply)}\r\n".encode() + reply + b"\r\n"
+    return f"*{len(reply)}\r\n".encode() + b"".join(encode(r) for r in reply)
+
+
+async def read_command(reader):
+    line = await reader.readline()
+    if not line:
+        return None
+    count = int(line[1:-2])
+    args = []
+    for _ in range(count):
+        length = int((await reader.readline())[1:-2])
+        args.append((await reader.readexactly(length + 2))[:-2])
+    return args
+
+
+def make_handler(store):
+    async def handle(reader, writer):
+        try:
+            while True:
+                args = await read_command(reader)
+                if args is None:
+                    break
+                try:
+                    reply = encode(store.execute(args[0].upper(), args[1:]))
+                except Exception as e:
+                    reply = f"-ERR {e}\r\n".encode()
+                writer.write(reply)
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return handle
+
+
+async def serve(host, port):
+    server = await asyncio.start_server(make_handler(FakeRedis()), host, port)
+    async with server:
+        await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=6390)
+    args = parser.parse_args()
+    asyncio.run(serve(args.host, args.port))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+"""
+A local fake search engine that answers like each of the search_with_*
+backends, after a configurable delay.
+
+    python bench/fake_search.py --port 8801 --delay 0.2
+    BACKEND=BING BING_SEARCH_V7_ENDPOINT=http://127.0.0.1:8801/v7.0/search python search4all.py
+
+Paths and the backend they stand in for:
+
+    GET  /v7.0/search        BING_SEARCH_V7_ENDPOINT
+    GET  /customsearch/v1    GOOGLE_SEARCH_ENDPOINT
+    POST /search             SERPER_SEARCH_ENDPOINT
+    GET  /search.json        SERPAPI_SEARCH_ENDPOINT
+    POST /search/            SEARCH1API_SEARCH_ENDPOINT
+    GET  /searxng            SEARXNG_BASE_URL
+
+The results depend on the query only, so that the same query gets the same
+pages from every backend, like real engines that mostly agree.
+"""
+import argparse
+import hashlib
+import json
+import random
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+WORDS = (
+    "the of and to in is was for on that with as by at from which or are search "
+    "engine answer question model language history city river science music world"
+).split()
+
+
+def fake_results(query, count):
+    rng = random.Random(hashlib.sha1(query.encode()).hexdigest())
+
+    def sentence(n):
+        return " ".join(rng.choice(WORDS) for _ in range(n)).capitalize() + "."
+
+    return [
+        {
+            "title": sentence(6),
+            "url": f"https://example{rng.randrange(50)}.com/{rng.randrange(10**6)}",
+            "snippet": " ".join(sentence(15) for _ in range(3)),
+        }
+        for _ in range(count)
+    ]
+
+
+def make_handler(args):
+    class FakeSearchHandler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def _reply(self, status, payload):
+            body = json.dumps(payload).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def _answer(self, query):
+            time.sleep(max(0, random.gauss(args.delay, args.jitter)))
+            if random.random() < args.error_rate:
+                self._reply(503, {"error": "fake outage"})
+                return
+            results = fake_results(query, args.results)
+            path = urlparse(self.path).path
+            if path == "/v7.0/search":
+                payload = {"webPages": {"value": [
+                    {"name": r["title"], "url": r["url"], "snippet": r["snippet"]} for r in results
+                ]}}
+            elif path == "/customsearch/v1":
+                payload = {"items": [
+                    {"title": r["title"], "link": r["url"], "snippet": r["snippet"]} for r in results
+                ]}
+            elif path == "/search" and self.command == "POST":
+                payload = {"organic": [
+                    {"title": r["title"], "link": r["url"], "snippet": r["snippet"]} for r in results
+                ]}
+            elif path == "/search.json":
+                payload = {"organic_results": [
+                    {"title": r["title"], "link": r["url"], "snippet": r["snippet"]} for r in results
+                ]}
+            elif path == "/search/" and self.command == "POST":
+                payload = {"results": [
+                    {"title": r["title"], "link": r["url"], "snippet": r["snippet"]} for r in results
+                ]}
+            elif path.startswith("/searxng"):
+                payload = {"results": [
+                    {"title": r["title"], "url": r["url"], "content": r["snippet"]} for r in results
+                ]}
+            else:
+                self._reply(404, {"error": f"unknown path {path}"})
+                return
+            self._reply(200, payload)
+
+        def do_GET(self):
+            params = parse_qs(urlparse(self.path).query)
+            self._answer((params.get("q") or [""])[0].replace(":auto ", ""))
+
+        def do_POST(self):
+            length = int(self.headers.get("Content-Length") or 0)
+            body = json.loads(self.rfile.read(length) or b"{}")
+            self._answer(body.get("q") or body.get("query") or "")
+
+        def log_message(self, *args):
+            pass
+
+    return FakeSearchHandler
+
+
+class StubServer(ThreadingHTTPServer):
+    """ Accepts a load test's burst of connections instead of resetting them. """
+    daemon_threads = True
+    request_queue_size = 1024
+
+
+def serve(host, port, args):
+    """ Starts the fake search engine in a thread and returns the server. """
+    server = StubServer((host, port), make_handler(args))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def add_arguments(parser):
+    parser.add_argument("--search-delay", dest="delay", type=float, default=0.2,
+                        help="mean latency in seconds")
+    parser.add_argument("--search-jitter", dest="jitter", type=float, default=0.05,
+                        help="standard deviation of the latency")
+    parser.add_argument("--search-error-rate", dest="error_rate", type=float, default=0.0)
+    parser.add_argument("--search-results", dest="results", type=int, default=10)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8801)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(args.host, args.port, args)
+    print(f"Fake search engine on http://{args.host}:{server.server_address[1]}")
+    threading.Event().wait()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,205 @@
+"""
+Drives /query at a target concurrency and reports throughput, TTFB, TTFT,
+end-to-end latency percentiles and the ratio of answers served from the KV.
+
+Against a running server:
+
+    python bench/load.py --url http://127.0.0.1:8800 --concurrency 32 --requests 500
+
+Or as a matrix: the fake search engine and the fake LLM server are started,
+then search4all.py is started with every combination of --workers,
+CHAT_HISTORY and RELATED_QUESTIONS and loaded in turn:
+
+    python bench/load.py --matrix --workers 1,4 --concurrency 32 --requests 300
+
+A share of the requests (--repeat-ratio) asks again a query that already got
+its answer, with the same search_uuid, like a shared link or a refreshed page.
+The responses are read as NDJSON: TTFT is the time to the first answer delta.
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import fake_llm  # noqa: E402
+import fake_search  # noqa: E402
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+async def one_query(client, url, query, search_uuid):
+    sample = {"ttfb": None, "ttft": None, "kv_hit": False, "ok": False}
+    start = time.perf_counter()
+    async with client.stream(
+        "POST",
+        f"{url}/query",
+        json={"query": query, "search_uuid": search_uuid, "stream_format": "ndjson"},
+    ) as response:
+        sample["kv_hit"] = response.headers.get("x-cache") == "HIT"
+        pending = ""
+        async for text in response.aiter_text():
+            if sample["ttfb"] is None:
+                sample["ttfb"] = time.perf_counter() - start
+            lines = (pending + text).split("\n")
+            pending = lines.pop()
+            for line in lines:
+                if not line:
+                    continue
+                event = json.loads(line)
+                if event["type"] == "delta" and sample["ttft"] is None:
+                    sample["ttft"] = time.perf_counter() - start
+                elif event["type"] == "done":
+                    sample["ok"] = True
+    sample["e2e"] = time.perf_counter() - start
+    return sample
+
+
+async def run_load(url, args):
+    rng = random.Random(0)
+    done = []
+    samples = []
+    errors = 0
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async def one(i):
+        nonlocal errors
+        async with semaphore:
+            if done and rng.random() < args.repeat_ratio:
+                query, search_uuid = rng.choice(done)
+            else:
+                query = f"bench question {rng.randrange(args.queries)}"
+                search_uuid = f"bench-{i}"
+            try:
+                sample = await one_query(client, url, query, search_uuid)
+            except (httpx.HTTPError, json.JSONDecodeError):
+                errors += 1
+                return
+            if sample["ok"]:
+                samples.append(sample)
+                done.append((query, search_uuid))
+            else:
+                errors += 1
+
+    limits = httpx.Limits(max_connections=args.concurrency * 2)
+    async with httpx.AsyncClient(timeout=120, limits=limits) as client:
+        start = time.perf_counter()
+        await asyncio.gather(*[one(i) for i in range(args.requests)])
+        elapsed = time.perf_counter() - start
+    return elapsed, samples, errors
+
+
+def percentiles(values):
+    values = sorted(v for v in values if v is not None)
+    if not values:
+        return "-"
+    pick = lambda p: values[min(len(values) - 1, int(len(values) * p))] * 1000
+    return f"{pick(0.5):6.0f} {pick(0.95):6.0f} {pick(0.99):6.0f}"
+
+
+def report(label, elapsed, samples, errors):
+    generated = [s for s in samples if not s["kv_hit"]]
+    kv_hits = len(samples) - len(generated)
+    print(
+        f"{label:<34} {len(samples) / elapsed:7.1f} q/s"
+        f" | ttfb {percentiles(s['ttfb'] for s in samples)}"
+        f" | ttft {percentiles(s['ttft'] for s in generated)}"
+        f" | e2e {percentiles(s['e2e'] for s in samples)}"
+        f" | kv hits {100 * kv_hits / max(1, len(samples)):3.0f}%"
+        f" | errors {errors}"
+    )
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def wait_for_port(port, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            with socket.create_connection(("127.0.0.1", port), timeout=1):
+                return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError(f"search4all did not start on port {port}")
+
+
+def run_matrix(args):
+    search_server = fake_search.serve("127.0.0.1", 0, args)
+    llm_server = fake_llm.serve("127.0.0.1", 0, args)
+    search_url = f"http://127.0.0.1:{search_server.server_address[1]}"
+    llm_url = f"http://127.0.0.1:{llm_server.server_address[1]}"
+    print(f"{'':<34} {'':>11} | {'p50    p95    p99 ms':>25} |")
+    for workers, chat_history, related in itertools.product(
+        [int(w) for w in args.workers.split(",")], ("0", "1"), ("0", "1")
+    ):
+        port = free_port()
+        with tempfile.TemporaryDirectory() as tmp:
+            env = dict(
+                os.environ,
+                PORT=str(port),
+                WORKERS=str(workers),
+                CHAT_HISTORY=chat_history,
+                RELATED_QUESTIONS=related,
+                BACKEND="BING",
+                BING_SEARCH_V7_ENDPOINT=f"{search_url}/v7.0/search",
+                BING_SEARCH_V7_SUBSCRIPTION_KEY="bench",
+                LLM_MODEL="gpt-bench",
+                OPENAI_BASE_URL=f"{llm_url}/v1",
+                OPENAI_API_KEY="bench",
+                KV_NAME=os.path.join(tmp, "search.db"),
+            )
+            server = subprocess.Popen(
+                [sys.executable, "search4all.py"],
+                cwd=ROOT,
+                env=env,
+                stdout=subprocess.DEVNULL,
+                stderr=subprocess.DEVNULL,
+            )
+            try:
+                wait_for_port(port)
+                elapsed, samples, errors = asyncio.run(run_load(f"http://127.0.0.1:{port}", args))
+            finally:
+                server.terminate()
+                server.wait()
+        report(
+            f"workers={workers} history={chat_history} related={related}",
+            elapsed, samples, errors,
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--url", help="a running server, instead of --matrix")
+    parser.add_argument("--matrix", action="store_true")
+    parser.add_argument("--workers", default="1,4", help="WORKERS values of --matrix")
+    parser.add_argument("--concurrency", type=int, default=32)
+    parser.add_argument("--requests", type=int, default=300)
+    parser.add_argument("--queries", type=int, default=100, help="distinct queries")
+    parser.add_argument("--repeat-ratio", type=float, default=0.2)
+    fake_search.add_arguments(parser)
+    fake_llm.add_arguments(parser)
+    args = parser.parse_args()
+    if args.matrix:
+        run_matrix(args)
+    elif args.url:
+        elapsed, samples, errors = asyncio.run(run_load(args.url.rstrip("/"), args))
+        report(args.url, elapsed, samples, errors)
+    else:
+        parser.error("either --url or --matrix is required")
+
+
+if __name__ == "__main__":
+    main()
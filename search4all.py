@@ -1,10 +1,20 @@
 import concurrent.futures
+import hashlib
 import json
+import multiprocessing
 import os
+import pickle
+import random
 import re
-import requests
+import sqlite3
+import threading
+import time
 import traceback
+import unicodedata
+import weakref
+import zlib
 import httpx
+from collections import Counter, OrderedDict
 from typing import AsyncGenerator
 from openai import AsyncOpenAI
 import asyncio
@@ -15,16 +25,13 @@ import urllib.parse
 import trafilatura
 from trafilatura import bare_extraction
 import tldextract
-from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from serpapi import GoogleSearch
 load_dotenv()
 
 import sanic
 from sanic import Sanic
 import sanic.exceptions
 from sanic.exceptions import HTTPException, InvalidUsage
-from sqlitedict import SqliteDict
 
 app = Sanic("search")
 
@@ -36,12 +43,14 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 ################################################################################
 
 # Search engine related. You don't really need to change this.
-BING_SEARCH_V7_ENDPOINT = "https://api.bing.microsoft.com/v7.0/search"
+# The endpoints can be overridden, e.g. to point at bench/fake_search.py.
+BING_SEARCH_V7_ENDPOINT = os.getenv("BING_SEARCH_V7_ENDPOINT") or "https://api.bing.microsoft.com/v7.0/search"
 BING_MKT = "en-US"
-GOOGLE_SEARCH_ENDPOINT = "https://customsearch.googleapis.com/customsearch/v1"
-SERPER_SEARCH_ENDPOINT = "https://google.serper.dev/search"
+GOOGLE_SEARCH_ENDPOINT = os.getenv("GOOGLE_SEARCH_ENDPOINT") or "https://customsearch.googleapis.com/customsearch/v1"
+SERPER_SEARCH_ENDPOINT = os.getenv("SERPER_SEARCH_ENDPOINT") or "https://google.serper.dev/search"
 SEARCHAPI_SEARCH_ENDPOINT = "https://www.searchapi.io/api/v1/search"
-SEARCH1API_SEARCH_ENDPOINT = "https://api.search1api.com/search/"
+SEARCH1API_SEARCH_ENDPOINT = os.getenv("SEARCH1API_SEARCH_ENDPOINT") or "https://api.search1api.com/search/"
+SERPAPI_SEARCH_ENDPOINT = os.getenv("SERPAPI_SEARCH_ENDPOINT") or "https://serpapi.com/search.json"
 
 
 
@@ -53,6 +62,194 @@ REFERENCE_COUNT = 8
 # does not respond within this time, we will return an error.
 DEFAULT_SEARCH_ENGINE_TIMEOUT = 5
 
+# Connection pool of the shared httpx client. Search engines and the LLM
+# endpoints are few, so keep-alive connections are reused across queries
+# instead of paying a TCP+TLS handshake on every request.
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS") or 100)
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS") or 20)
+HTTP_KEEPALIVE_EXPIRY = 30
+
+# HTTP/2 needs the optional `h2` package (pip install httpx[http2]).
+try:
+    import h2  # noqa: F401
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+# Search results are cached by normalized query text and backend. Within
+# SEARCH_CACHE_TTL seconds an entry is served as is; for SEARCH_CACHE_STALE_TTL
+# seconds more it is served stale while being refreshed in the background.
+# Set SEARCH_CACHE_TTL=0 to disable the cache.
+SEARCH_CACHE_TTL = int(os.getenv("SEARCH_CACHE_TTL") or 600)
+SEARCH_CACHE_STALE_TTL = int(os.getenv("SEARCH_CACHE_STALE_TTL") or 3600)
+SEARCH_CACHE_SIZE = int(os.getenv("SEARCH_CACHE_SIZE") or 1024)
+
+# The optional semantic cache, enabled with SEMANTIC_CACHE=1, answers a query
+# that is nearly the same as one answered less than SEMANTIC_CACHE_TTL seconds
+# ago with the same answer. Two queries only match if they have the same words
+# and numbers in the same order, but for the SEMANTIC_CACHE_STOPWORDS; they
+# are then compared as hashed word and character trigram vectors, and
+# SEMANTIC_CACHE_THRESHOLD is the minimum cosine similarity. Similar vectors
+# alone are not enough: "ibuprofen with alcohol" and "ibuprofen without
+# alcohol", or "celsius to fahrenheit" and "fahrenheit to celsius", are close.
+SEMANTIC_CACHE_THRESHOLD = float(os.getenv("SEMANTIC_CACHE_THRESHOLD") or 0.9)
+SEMANTIC_CACHE_TTL = int(os.getenv("SEMANTIC_CACHE_TTL") or 3600)
+SEMANTIC_CACHE_SIZE = int(os.getenv("SEMANTIC_CACHE_SIZE") or 2048)
+SEMANTIC_CACHE_DIMS = 1 << 18
+SEMANTIC_CACHE_STOPWORDS = frozenset(
+    "a an the is are was were be been am do does did s please".split()
+)
+
+# Related questions are cached by normalized query and a hash of the search
+# snippets they were generated from, for RELATED_CACHE_TTL seconds (0
+# disables the cache).
+RELATED_CACHE_TTL = int(os.getenv("RELATED_CACHE_TTL") or 3600)
+RELATED_CACHE_SIZE = int(os.getenv("RELATED_CACHE_SIZE") or 1024)
+
+# BACKEND may list several search engines, e.g. BING,SERPER,SEARXNG, queried
+# concurrently. With SEARCH_MODE=race the first engine that returns results
+# wins; with SEARCH_MODE=merge the results that arrive within
+# SEARCH_MERGE_DEADLINE seconds are deduplicated and rank-fused. Only the
+# SEARCH_FANOUT healthiest engines are queried (0 queries all of them).
+SEARCH_MODE = (os.getenv("SEARCH_MODE") or "race").lower()
+SEARCH_MERGE_DEADLINE = float(os.getenv("SEARCH_MERGE_DEADLINE") or 1.5)
+SEARCH_FANOUT = int(os.getenv("SEARCH_FANOUT") or 0)
+SEARCH_ENGINE_RETRY_AFTER = 30
+
+# Resilience of the search backends. A backend whose last
+# SEARCH_BREAKER_THRESHOLD calls failed is not called for
+# SEARCH_BREAKER_RESET seconds; then one probe call decides whether it is back.
+# A failed call is retried up to SEARCH_RETRIES times with jittered
+# exponential backoff, as long as the whole search fits in SEARCH_DEADLINE
+# seconds and the retry budget allows it: retries may add at most
+# SEARCH_RETRY_RATIO of the search calls, plus a small steady allowance, so
+# that retries never multiply the load on an unhealthy backend.
+SEARCH_BREAKER_THRESHOLD = int(os.getenv("SEARCH_BREAKER_THRESHOLD") or 5)
+SEARCH_BREAKER_RESET = float(os.getenv("SEARCH_BREAKER_RESET") or 30)
+SEARCH_RETRIES = int(os.getenv("SEARCH_RETRIES") or 2)
+SEARCH_RETRY_BACKOFF = 0.1
+SEARCH_RETRY_RATIO = float(os.getenv("SEARCH_RETRY_RATIO") or 0.1)
+SEARCH_RETRY_MIN_PER_SECOND = 1
+SEARCH_DEADLINE = float(os.getenv("SEARCH_DEADLINE") or 8)
+# The k of reciprocal rank fusion: a result scores sum(1 / (k + rank)).
+SEARCH_RRF_K = 60
+
+# Admission control of one worker: at most ADMISSION_MAX_* of each stage run at
+# once, up to ADMISSION_QUEUE_SIZE more wait for a slot, for no longer than
+# ADMISSION_MAX_WAIT seconds, and the others are answered 429 right away with
+# a Retry-After of ADMISSION_RETRY_AFTER seconds. A limit of 0 disables it.
+ADMISSION_MAX_QUERIES = int(os.getenv("ADMISSION_MAX_QUERIES") or 64)
+ADMISSION_MAX_SEARCHES = int(os.getenv("ADMISSION_MAX_SEARCHES") or 32)
+ADMISSION_MAX_LLM_STREAMS = int(os.getenv("ADMISSION_MAX_LLM_STREAMS") or 32)
+ADMISSION_MAX_RELATED = int(os.getenv("ADMISSION_MAX_RELATED") or 16)
+ADMISSION_QUEUE_SIZE = int(os.getenv("ADMISSION_QUEUE_SIZE") or 64)
+ADMISSION_MAX_WAIT = float(os.getenv("ADMISSION_MAX_WAIT") or 10)
+ADMISSION_RETRY_AFTER = int(os.getenv("ADMISSION_RETRY_AFTER") or 1)
+
+# Upper bounds, in seconds, of the buckets of the latency histograms exposed
+# on /metrics. With SERVER_TIMING=1 the stages that are over when the response
+# starts are also sent in a Server-Timing header.
+METRICS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+# The streamed response is written in frames: deltas are buffered for up to
+# STREAM_FLUSH_INTERVAL seconds or STREAM_FLUSH_BYTES characters, instead of
+# one write and one HTTP chunk per token. A delta that comes after a pause,
+# like the first token, is written right away.
+STREAM_FLUSH_INTERVAL = float(os.getenv("STREAM_FLUSH_INTERVAL") or 0.03)
+STREAM_FLUSH_BYTES = int(os.getenv("STREAM_FLUSH_BYTES") or 4096)
+# A generation nobody reads anymore is cancelled after STREAM_GRACE_PERIOD
+# seconds, so that a refreshed page can still attach to it.
+STREAM_GRACE_PERIOD = float(os.getenv("STREAM_GRACE_PERIOD") or 5)
+
+# With several workers, a generation in progress in one worker is published to
+# the KV as a partial result every KV_PARTIAL_INTERVAL seconds, so that the
+# other workers can follow it instead of generating again.
+KV_PARTIAL_INTERVAL = 1
+# A partial result that has not been updated for this long is abandoned.
+KV_PARTIAL_STALE_AFTER = 30
+
+# Full page content enrichment, enabled with FULL_CONTENT=1. The result pages
+# are fetched and extracted within FULL_CONTENT_DEADLINE seconds in total; any
+# page that is not ready by then falls back to its snippet.
+FULL_CONTENT_DEADLINE = float(os.getenv("FULL_CONTENT_DEADLINE") or 3)
+FULL_CONTENT_MAX_CONCURRENCY = int(os.getenv("FULL_CONTENT_MAX_CONCURRENCY") or 16)
+FULL_CONTENT_MAX_PER_HOST = int(os.getenv("FULL_CONTENT_MAX_PER_HOST") or 2)
+FULL_CONTENT_PROCESSES = int(os.getenv("FULL_CONTENT_PROCESSES") or 2)
+# The extracted text of a single page is truncated to this many characters.
+FULL_CONTENT_MAX_CHARS = 4000
+# At most this many bytes of a page are downloaded. Pages that announce a
+# larger Content-Length, or that are not HTML, are not downloaded at all.
+FULL_CONTENT_MAX_BYTES = int(os.getenv("FULL_CONTENT_MAX_BYTES") or 2 * 1024 * 1024)
+
+# Extracted page contents are cached on disk, compressed, up to
+# CONTENT_CACHE_MAX_BYTES (0 disables the cache). Within CONTENT_CACHE_FRESH_TTL
+# seconds a page is served from the cache; after that it is revalidated with
+# its ETag / Last-Modified, so an unchanged page costs a 304 and no re-parse.
+CONTENT_CACHE_MAX_BYTES = int(os.getenv("CONTENT_CACHE_MAX_BYTES") or 256 * 1024 * 1024)
+CONTENT_CACHE_FRESH_TTL = int(os.getenv("CONTENT_CACHE_FRESH_TTL") or 3600)
+
+# Writes to the KV are queued and flushed in one transaction every
+# KV_FLUSH_INTERVAL seconds, or as soon as KV_FLUSH_SIZE writes are queued.
+KV_FLUSH_INTERVAL = float(os.getenv("KV_FLUSH_INTERVAL") or 0.5)
+KV_FLUSH_SIZE = int(os.getenv("KV_FLUSH_SIZE") or 256)
+# Seconds a KV connection waits for the write lock held by another worker.
+KV_BUSY_TIMEOUT = 30
+# The table SqliteDict uses by default, so that old KV files can be read.
+KV_TABLE = "unnamed"
+# Retention of the stored results. KV_TTL is the lifetime of an entry in
+# seconds and KV_MAX_BYTES the size budget of the store, beyond which the least
+# recently read entries are evicted; 0 disables either. Both are enforced by a
+# compaction job that runs every KV_COMPACT_INTERVAL seconds. The LMDB backend
+# only has the TTL, its size is capped by KV_LMDB_MAP_SIZE.
+KV_TTL = int(os.getenv("KV_TTL") or 0)
+KV_MAX_BYTES = int(os.getenv("KV_MAX_BYTES") or 0)
+KV_COMPACT_INTERVAL = int(os.getenv("KV_COMPACT_INTERVAL") or 3600)
+# The file is VACUUMed when more than this share of its pages is free.
+KV_VACUUM_FREE_RATIO = 0.25
+# Values larger than this are stored zlib compressed.
+KV_COMPRESS_MIN_BYTES = 512
+# The map size of the LMDB backend, which is the maximum size of its file.
+KV_LMDB_MAP_SIZE = int(os.getenv("KV_LMDB_MAP_SIZE") or 16 * 1024 ** 3)
+# The LMDB compaction deletes the chat history of a conversation whose result
+# is gone, once its last turn is this old: the result is written after it.
+KV_LMDB_ORPHAN_GRACE = 60
+# Connections to the Redis backend kept by each worker.
+KV_REDIS_POOL_SIZE = 16
+# Partial results are only useful while the generation runs.
+KV_PARTIAL_TTL = 600
+
+# Seconds allowed to open the connections to the LLM endpoints at startup.
+LLM_WARM_UP_TIMEOUT = 5
+# When several LLM endpoints are configured with LLM_ENDPOINTS, a call that
+# has no first token after LLM_HEDGE_DELAY seconds is also sent to the next
+# endpoint (0 disables hedging). The related questions are not streamed and
+# take longer, so they are hedged after LLM_RELATED_HEDGE_DELAY seconds. A
+# failing endpoint is skipped for LLM_COOLDOWN seconds, doubling on every
+# failure up to LLM_COOLDOWN_MAX. An endpoint that lost a hedged race is
+# tried after the others for LLM_SLOW_DEMOTION seconds.
+LLM_HEDGE_DELAY = float(os.getenv("LLM_HEDGE_DELAY") or 3)
+LLM_RELATED_HEDGE_DELAY = float(os.getenv("LLM_RELATED_HEDGE_DELAY") or 10)
+LLM_COOLDOWN = 5
+LLM_COOLDOWN_MAX = 300
+LLM_SLOW_DEMOTION = 60
+
+# Token budgets of the answer prompt. The search results are deduplicated and
+# packed by relevance into PROMPT_CONTEXT_TOKENS, and the oldest turns of the
+# chat history are dropped beyond PROMPT_HISTORY_TOKENS. A result that only
+# partly fits is truncated if at least PROMPT_MIN_CONTEXT_TOKENS of it fit.
+PROMPT_CONTEXT_TOKENS = int(os.getenv("PROMPT_CONTEXT_TOKENS") or 3000)
+PROMPT_HISTORY_TOKENS = int(os.getenv("PROMPT_HISTORY_TOKENS") or 2000)
+PROMPT_MIN_CONTEXT_TOKENS = 64
+# Two results whose word trigrams overlap this much are near-duplicates.
+CONTEXT_DUPLICATE_SIMILARITY = 0.8
+
+# Tokens are counted with tiktoken when it is installed and its encoding is
+# available, and estimated from the characters otherwise.
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
 # 默认记录的对话历史长度
 MAX_HISTORY_LEN = 10
 
@@ -101,49 +298,1368 @@ stop_words = [
 # and quality.
 
 
-class KVWrapper(object):
-    def __init__(self, kv_name):
-        self._db = SqliteDict(filename=kv_name)
+class KVError(Exception):
+    """ An error reported by a KV backend. """
+
+
+def _encode_value(value, compress_min_bytes: float = KV_COMPRESS_MIN_BYTES) -> bytes:
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) >= compress_min_bytes:
+        data = zlib.compress(data)
+    return data
+
+
+def _decode_value(data):
+    data = bytes(data)
+    # Pickles start with the PROTO opcode, anything else is compressed.
+    if data[:1] != b"\x80":
+        data = zlib.decompress(data)
+    return pickle.loads(data)
+
+
+def _results_hash(search_results) -> str:
+    return hashlib.sha1(json.dumps(search_results, sort_keys=True).encode()).hexdigest()
+
+
+class KVBackend(object):
+    """
+    The interface of the stores behind `_app.ctx.kv`, picked with KV_BACKEND.
+
+    The request handlers only use the async methods. By default they run the
+    blocking methods in `executor`, the default executor if it is None;
+    backends that can do better override them.
+    """
+    executor = None
 
     def get(self, key: str):
-        v = self._db[key]
+        raise NotImplementedError
+
+    def put(self, key: str, value, ttl: float = None):
+        raise NotImplementedError
+
+    def append_turn(self, search_uuid: str, turn: dict):
+        raise NotImplementedError
+
+    def get_history(self, search_uuid: str, limit: int = MAX_HISTORY_LEN):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    async def aget(self, key: str):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, self.get, key)
+
+    async def aput(self, key: str, value, ttl: float = None):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.put, key, value, ttl)
+
+    async def aappend_turn(self, search_uuid: str, turn: dict):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.append_turn, search_uuid, turn)
+
+    async def aget_history(self, search_uuid: str, limit: int = MAX_HISTORY_LEN):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, self.get_history, search_uuid, limit
+        )
+
+    async def aclose(self):
+        await asyncio.get_running_loop().run_in_executor(self.executor, self.close)
+
+
+class KVWrapper(KVBackend):
+    """
+    A key-value store on SQLite. The file layout is the same as SqliteDict's,
+    so existing KV files keep working.
+
+    Writes are write-behind: they are queued in memory, and a background thread
+    flushes them in grouped transactions every KV_FLUSH_INTERVAL seconds or as
+    soon as KV_FLUSH_SIZE writes are pending. The database runs in WAL mode and
+    every thread reads through its own connection, so reads never wait for a
+    flush. Queued writes are visible to `get` right away.
+
+    Values larger than KV_COMPRESS_MIN_BYTES are stored zlib compressed. Every
+    KV_COMPACT_INTERVAL seconds the flusher also drops the entries older than
+    their TTL, evicts the least recently used ones above KV_MAX_BYTES, and
+    VACUUMs the file when a large part of it is free.
+    """
+    def __init__(self, kv_name, flush_interval=None, flush_size=None, ttl=None,
+                 max_bytes=None, compress_min_bytes=None):
+        self._filename = kv_name
+        self._flush_interval = flush_interval or KV_FLUSH_INTERVAL
+        self._flush_size = flush_size or KV_FLUSH_SIZE
+        self._ttl = KV_TTL if ttl is None else ttl
+        self._max_bytes = KV_MAX_BYTES if max_bytes is None else max_bytes
+        self._compress_min_bytes = (
+            KV_COMPRESS_MIN_BYTES if compress_min_bytes is None else compress_min_bytes
+        )
+        self._lock = threading.RLock()
+        # key -> (value, expires_at)
+        self._pending = {}
+        self._flushing = {}
+        self._pending_turns = []
+        self._flushing_turns = []
+        # key -> last access time, for the LRU eviction.
+        self._touched = {}
+        self._last_compaction = time.monotonic()
+        self._local = threading.local()
+        self._wakeup = threading.Event()
+        self._closed = False
+        self._db = self._connect()
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(f'CREATE TABLE IF NOT EXISTS "{KV_TABLE}" (key TEXT PRIMARY KEY, value BLOB)')
+        self._add_columns(KV_TABLE, {"expires_at": "REAL", "accessed_at": "REAL", "size": "INTEGER"})
+        self._db.execute(f'UPDATE "{KV_TABLE}" SET size = length(value) WHERE size IS NULL')
+        self._db.execute(f'CREATE INDEX IF NOT EXISTS kv_accessed_at ON "{KV_TABLE}" (accessed_at)')
+        self._db.execute(f'CREATE INDEX IF NOT EXISTS kv_expires_at ON "{KV_TABLE}" (expires_at)')
+        # Chat history is stored one row per turn, and the search results of
+        # the turns are deduplicated by content hash.
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS history (search_uuid TEXT, turn_no INTEGER, query TEXT,"
+            " results_hash TEXT, llm_response TEXT, related_questions TEXT,"
+            " PRIMARY KEY (search_uuid, turn_no))"
+        )
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS history_results (hash TEXT PRIMARY KEY, search_results TEXT)"
+        )
+        self._add_columns("history", {"created_at": "REAL"})
+        self._flusher = threading.Thread(target=self._run_flusher, name="kv-flusher", daemon=True)
+        self._flusher.start()
+
+    def _connect(self):
+        db = sqlite3.connect(
+            self._filename, timeout=KV_BUSY_TIMEOUT, check_same_thread=False, isolation_level=None
+        )
+        db.execute("PRAGMA synchronous=NORMAL")
+        return db
+
+    def _add_columns(self, table, columns):
+        existing = {row[1] for row in self._db.execute(f'PRAGMA table_info("{table}")')}
+        for name, kind in columns.items():
+            if name not in existing:
+                self._db.execute(f'ALTER TABLE "{table}" ADD COLUMN {name} {kind}')
+
+    def _reader(self):
+        db = getattr(self._local, "db", None)
+        if db is None:
+            db = self._local.db = self._connect()
+        return db
+
+    def get(self, key: str):
+        with self._lock:
+            queued = key in self._pending or key in self._flushing
+            if queued:
+                v = (self._pending[key] if key in self._pending else self._flushing[key])[0]
+            elif self._max_bytes:
+                self._touched[key] = time.time()
+        if not queued:
+            row = self._reader().execute(
+                f'SELECT value, expires_at FROM "{KV_TABLE}" WHERE key = ?', (key,)
+            ).fetchone()
+            if row is None or (row[1] is not None and row[1] < time.time()):
+                raise KeyError(key)
+            v = _decode_value(row[0])
         if v is None:
             raise KeyError(key)
         return v
 
-    def put(self, key: str, value: str):
-        self._db[key] = value
-        self._db.commit()
-    
-    def append(self, key: str, value):
-        """ 记录聊天历史 """
-        self._db[key] = self._db.get(key, [])
-        # 最长记录的对话轮数 MAX_HISTORY_LEN
-        _ = self._db[key][-MAX_HISTORY_LEN:]
-        _.append(value)
-        self._db[key] = _
-        self._db.commit()
-
-# 格式化输出部分
-def extract_all_sections(text: str):
-    # 定义正则表达式模式以匹配各部分
-    sections_pattern = r"(.*?)__LLM_RESPONSE__(.*?)(__RELATED_QUESTIONS__(.*))?$"
-    
-    # 使用正则表达式查找各部分内容
-    match = re.search(sections_pattern, text, re.DOTALL)
+    def put(self, key: str, value, ttl: float = None):
+        """
+        Queues a write. The entry expires after `ttl` seconds, by default the
+        KV_TTL of the store; 0 keeps it forever.
+        """
+        ttl = self._ttl if ttl is None else ttl
+        with self._lock:
+            self._pending[key] = (value, time.time() + ttl if ttl else None)
+            if len(self._pending) >= self._flush_size:
+                self._wakeup.set()
     
-    # 从匹配结果中提取文本，如果没有匹配则返回None
-    if match:
-        search_results = match.group(1).strip()  # 前置文本作为搜索结果
-        llm_response = match.group(2).strip()    # 问题回答部分
-        related_questions = match.group(4).strip() if match.group(4) else ""  # 相关问题文本，如果不存在则返回空字符串
+    def append_turn(self, search_uuid: str, turn: dict):
+        """ 记录聊天历史: queues one turn, which is appended as its own row. """
+        with self._lock:
+            self._pending_turns.append((search_uuid, turn))
+            if len(self._pending) + len(self._pending_turns) >= self._flush_size:
+                self._wakeup.set()
+
+    def get_history(self, search_uuid: str, limit: int = MAX_HISTORY_LEN):
+        """
+        Returns the last `limit` turns of a conversation, oldest first.
+        """
+        # flush commits the turns and takes them off the queue under the lock,
+        # so reading both under the lock sees every turn exactly once.
+        with self._lock:
+            queued = [
+                turn for sid, turn in self._flushing_turns + self._pending_turns
+                if sid == search_uuid
+            ]
+            rows = self._reader().execute(
+                "SELECT h.query, r.search_results, h.llm_response, h.related_questions"
+                " FROM history h LEFT JOIN history_results r ON h.results_hash = r.hash"
+                " WHERE h.search_uuid = ? ORDER BY h.turn_no DESC LIMIT ?",
+                (search_uuid, limit),
+            ).fetchall()
+        history = [
+            {
+                "query": query,
+                "search_results": json.loads(search_results) if search_results else None,
+                "llm_response": llm_response,
+                "related_questions": json.loads(related_questions) if related_questions else None,
+            }
+            for query, search_results, llm_response, related_questions in reversed(rows)
+        ] + queued
+        if len(history) < limit:
+            # Conversations started before the history table was introduced
+            # keep their first turns in the old blob.
+            try:
+                history = self.get(f"{search_uuid}_history") + history
+            except KeyError:
+                pass
+        return history[-limit:]
+
+    def _write_turns(self, turns):
+        for search_uuid, turn in turns:
+            results_hash = None
+            related_questions = turn.get("related_questions")
+            try:
+                search_results = json.dumps(turn.get("search_results"), sort_keys=True)
+                related_questions = json.dumps(related_questions) if related_questions else None
+            except (TypeError, ValueError) as e:
+                # Failing the transaction would fail it again on every retry.
+                logger.error(f"Turn of {search_uuid} cannot be encoded, dropping it: {e!r}")
+                continue
+            if turn.get("search_results"):
+                results_hash = _results_hash(turn["search_results"])
+                # Follow-up turns mostly reuse the same search results, which are
+                # then stored once.
+                self._db.execute(
+                    "INSERT OR IGNORE INTO history_results (hash, search_results) VALUES (?, ?)",
+                    (results_hash, search_results),
+                )
+            self._db.execute(
+                "INSERT INTO history (search_uuid, turn_no, query, results_hash, llm_response,"
+                " related_questions, created_at) SELECT ?, COALESCE(MAX(turn_no), 0) + 1, ?, ?, ?, ?, ?"
+                " FROM history WHERE search_uuid = ?",
+                (
+                    search_uuid,
+                    turn.get("query"),
+                    results_hash,
+                    turn.get("llm_response"),
+                    related_questions,
+                    time.time(),
+                    search_uuid,
+                ),
+            )
+
+    def flush(self):
+        """
+        Writes all the queued writes in one transaction.
+        """
+        with self._lock:
+            if not self._pending and not self._pending_turns:
+                return
+            self._flushing, self._pending = self._pending, {}
+            self._flushing_turns, self._pending_turns = self._pending_turns, []
+        now = time.time()
+        rows = []
+        try:
+            for key, (value, expires_at) in list(self._flushing.items()):
+                try:
+                    data = _encode_value(value, self._compress_min_bytes)
+                except Exception as e:
+                    # It would fail again on every retry.
+                    logger.error(f"KV value of {key} cannot be encoded, dropping it: {e!r}")
+                    with self._lock:
+                        del self._flushing[key]
+                    continue
+                rows.append((key, data, expires_at, now, len(data)))
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    f'REPLACE INTO "{KV_TABLE}" (key, value, expires_at, accessed_at, size)'
+                    " VALUES (?, ?, ?, ?, ?)",
+                    rows,
+                )
+                self._write_turns(self._flushing_turns)
+                # Committed and off the queue at once, see get_history.
+                with self._lock:
+                    self._db.commit()
+                    self._flushing = {}
+                    self._flushing_turns = []
+        except Exception as e:
+            logger.error(f"KV flush of {len(rows)} writes failed, will retry: {e}")
+            with self._lock:
+                # Newer writes to the same keys win over the failed ones.
+                self._pending = {**self._flushing, **self._pending}
+                self._pending_turns = self._flushing_turns + self._pending_turns
+        finally:
+            with self._lock:
+                self._flushing = {}
+                self._flushing_turns = []
+
+    async def aput(self, key: str, value, ttl: float = None):
+        self.put(key, value, ttl)
+
+    async def aappend_turn(self, search_uuid: str, turn: dict):
+        self.append_turn(search_uuid, turn)
+
+    def _write_touches(self):
+        with self._lock:
+            touched, self._touched = self._touched, {}
+        if touched:
+            with self._db:
+                self._db.execute("BEGIN")
+                self._db.executemany(
+                    f'UPDATE "{KV_TABLE}" SET accessed_at = ? WHERE key = ?',
+                    [(t, key) for key, t in touched.items()],
+                )
+
+    def compact(self):
+        """
+        Deletes the expired entries, evicts the least recently used ones above
+        the size budget together with their chat history, and VACUUMs the file
+        when much of it is free.
+        """
+        now = time.time()
+        with self._db:
+            self._db.execute("BEGIN")
+            expired = self._db.execute(
+                f'DELETE FROM "{KV_TABLE}" WHERE expires_at < ?', (now,)
+            ).rowcount
+            if self._ttl:
+                self._db.execute("DELETE FROM history WHERE created_at < ?", (now - self._ttl,))
+        evicted = 0
+        if self._max_bytes:
+            self._write_touches()
+            total = self._db.execute(f'SELECT COALESCE(SUM(size), 0) FROM "{KV_TABLE}"').fetchone()[0]
+            # Evict down to 90% of the budget, in small transactions so that
+            # the other workers are not locked out for long.
+            while total > self._max_bytes * 0.9:
+                rows = self._db.execute(
+                    f'SELECT key, size FROM "{KV_TABLE}" ORDER BY accessed_at LIMIT 500'
+                ).fetchall()
+                if not rows:
+                    break
+                keys = []
+                for key, size in rows:
+                    keys.append((key,))
+                    total -= size or 0
+                    if total <= self._max_bytes * 0.9:
+                        break
+                with self._db:
+                    self._db.execute("BEGIN")
+                    self._db.executemany(f'DELETE FROM "{KV_TABLE}" WHERE key = ?', keys)
+                    # The turns of a conversation go with its result, or a
+                    # follow-up would find the history but not the result.
+                    self._db.executemany("DELETE FROM history WHERE search_uuid = ?", keys)
+                evicted += len(keys)
+        with self._db:
+            self._db.execute("BEGIN")
+            self._db.execute(
+                "DELETE FROM history_results WHERE hash NOT IN"
+                " (SELECT results_hash FROM history WHERE results_hash IS NOT NULL)"
+            )
+        free_pages = self._db.execute("PRAGMA freelist_count").fetchone()[0]
+        pages = self._db.execute("PRAGMA page_count").fetchone()[0]
+        logger.info(f"KV compaction: {expired} expired, {evicted} evicted, {free_pages}/{pages} pages free.")
+        if pages and free_pages / pages > KV_VACUUM_FREE_RATIO:
+            try:
+                self._db.execute("VACUUM")
+            except sqlite3.OperationalError as e:
+                # Another worker holds the database; it will be retried.
+                logger.info(f"KV vacuum skipped: {e}")
+
+    def _run_flusher(self):
+        while not self._closed:
+            self._wakeup.wait(self._flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                # Keep the flusher alive, or every later write would be lost.
+                logger.error(f"KV flush failed: {e!r}")
+            if time.monotonic() - self._last_compaction > KV_COMPACT_INTERVAL:
+                self._last_compaction = time.monotonic()
+                try:
+                    self.compact()
+                except Exception as e:
+                    logger.error(f"KV compaction failed: {e}")
+
+    def close(self):
+        """
+        Stops the background flusher and writes everything that is queued.
+        """
+        self._closed = True
+        self._wakeup.set()
+        self._flusher.join()
+        self.flush()
+        self._write_touches()
+        self._db.close()
+
+
+class LMDBKV(KVBackend):
+    """
+    A memory mapped store on LMDB, for several workers on one host. LMDB lets
+    any number of processes read without locks while one of them writes, so
+    reads are served inline and only writes go to a thread. Needs the optional
+    `lmdb` package.
+
+    Every KV_COMPACT_INTERVAL seconds a background thread deletes the expired
+    entries, the chat history of the conversations whose result is gone and
+    the search results no turn refers to. There is no LRU eviction, the store
+    is bounded by KV_LMDB_MAP_SIZE and KV_TTL.
+    """
+    def __init__(self, path: str, map_size: int = None, ttl: float = None):
+        try:
+            import lmdb
+        except ImportError:
+            raise RuntimeError("KV_BACKEND=LMDB requires the lmdb package: pip install lmdb")
+        if KV_MAX_BYTES:
+            raise RuntimeError(
+                "KV_MAX_BYTES is not supported by KV_BACKEND=LMDB, use KV_LMDB_MAP_SIZE and KV_TTL."
+            )
+        self._ttl = KV_TTL if ttl is None else ttl
+        self._env = lmdb.open(path, map_size=map_size or KV_LMDB_MAP_SIZE, max_dbs=3)
+        self._kv = self._env.open_db(b"kv")
+        self._turns = self._env.open_db(b"turns")
+        self._results = self._env.open_db(b"results")
+        self._closed = threading.Event()
+        self._compactor = threading.Thread(
+            target=self._run_compactor, name="kv-compactor", daemon=True
+        )
+        self._compactor.start()
+
+    def get(self, key: str):
+        with self._env.begin(db=self._kv) as txn:
+            data = txn.get(key.encode())
+        if data is None:
+            raise KeyError(key)
+        expires_at, v = _decode_value(data)
+        if v is None or (expires_at is not None and expires_at < time.time()):
+            raise KeyError(key)
+        return v
+
+    def put(self, key: str, value, ttl: float = None):
+        ttl = self._ttl if ttl is None else ttl
+        data = _encode_value((time.time() + ttl if ttl else None, value))
+        with self._env.begin(write=True, db=self._kv) as txn:
+            txn.put(key.encode(), data)
+
+    def append_turn(self, search_uuid: str, turn: dict):
+        turn = dict(turn, created_at=time.time())
+        search_results = turn.pop("search_results", None)
+        if search_results:
+            turn["results_hash"] = _results_hash(search_results)
+        count_key = f"{search_uuid}\x00#".encode()
+        with self._env.begin(write=True) as txn:
+            if search_results:
+                txn.put(
+                    turn["results_hash"].encode(),
+                    _encode_value(search_results),
+                    db=self._results,
+                    overwrite=False,
+                )
+            turn_no = int(txn.get(count_key, b"0", db=self._turns)) + 1
+            txn.put(f"{search_uuid}\x00{turn_no:010d}".encode(), _encode_value(turn), db=self._turns)
+            txn.put(count_key, str(turn_no).encode(), db=self._turns)
+
+    def get_history(self, search_uuid: str, limit: int = MAX_HISTORY_LEN):
+        history = []
+        with self._env.begin() as txn:
+            count = int(txn.get(f"{search_uuid}\x00#".encode(), b"0", db=self._turns))
+            for turn_no in range(max(1, count - limit + 1), count + 1):
+                turn = _decode_value(
+                    txn.get(f"{search_uuid}\x00{turn_no:010d}".encode(), db=self._turns)
+                )
+                turn.pop("created_at", None)
+                results_hash = turn.pop("results_hash", None)
+                results = txn.get(results_hash.encode(), db=self._results) if results_hash else None
+                turn["search_results"] = _decode_value(results) if results else None
+                history.append(turn)
+        return history
+
+    def compact(self):
+        """
+        Deletes the expired entries, the turns of the conversations whose
+        result is gone, and the search results no turn refers to. It is one
+        write transaction, so that a turn and its search results written
+        meanwhile are seen together; readers are never blocked.
+        """
+        now = time.time()
+        with self._env.begin(write=True) as txn:
+            expired = []
+            for key, data in txn.cursor(db=self._kv):
+                expires_at, _ = _decode_value(data)
+                if expires_at is not None and expires_at < now:
+                    expired.append(key)
+            for key in expired:
+                txn.delete(key, db=self._kv)
+            # search_uuid -> (keys, results hashes, time of the last turn)
+            conversations = {}
+            for key, data in txn.cursor(db=self._turns):
+                search_uuid, _, turn_no = key.partition(b"\x00")
+                keys, hashes, last_turn = conversations.setdefault(search_uuid, ([], set(), [0]))
+                keys.append(key)
+                if turn_no != b"#":
+                    turn = _decode_value(data)
+                    if turn.get("results_hash"):
+                        hashes.add(turn["results_hash"].encode())
+                    last_turn[0] = max(last_turn[0], turn.get("created_at", 0))
+            referenced = set()
+            orphaned = 0
+            for search_uuid, (keys, hashes, last_turn) in conversations.items():
+                if (
+                    txn.get(search_uuid, db=self._kv) is None
+                    and last_turn[0] < now - KV_LMDB_ORPHAN_GRACE
+                ):
+                    for key in keys:
+                        txn.delete(key, db=self._turns)
+                    orphaned += 1
+                else:
+                    referenced |= hashes
+            unreferenced = [key for key, _ in txn.cursor(db=self._results) if key not in referenced]
+            for key in unreferenced:
+                txn.delete(key, db=self._results)
+        logger.info(
+            f"KV compaction: {len(expired)} expired, {orphaned} histories and"
+            f" {len(unreferenced)} search results orphaned."
+        )
+
+    def _run_compactor(self):
+        while not self._closed.wait(KV_COMPACT_INTERVAL):
+            try:
+                self.compact()
+            except Exception as e:
+                logger.error(f"KV compaction failed: {e!r}")
+
+    def close(self):
+        self._closed.set()
+        self._compactor.join()
+        self._env.close()
+
+    async def aget(self, key: str):
+        return self.get(key)
+
+    async def aget_history(self, search_uuid: str, limit: int = MAX_HISTORY_LEN):
+        return self.get_history(search_uuid, limit)
+
+
+class RedisKV(KVBackend):
+    """
+    A store on any server that speaks the Redis protocol, shared by all the
+    workers and hosts. The client is a small pooled RESP implementation on
+    asyncio streams, so it only has async methods and needs no extra package.
+    """
+    def __init__(self, url: str, pool_size: int = None, ttl: float = None):
+        parsed = urlparse(url)
+        self._host = parsed.hostname or "localhost"
+        self._port = parsed.port or 6379
+        self._password = parsed.password
+        self._db = int(parsed.path.lstrip("/") or 0)
+        self._ttl = KV_TTL if ttl is None else ttl
+        self._semaphore = asyncio.Semaphore(pool_size or KV_REDIS_POOL_SIZE)
+        self._idle = []
+
+    @staticmethod
+    def _pack(args) -> bytes:
+        parts = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode()
+            parts.append(f"${len(arg)}\r\n".encode())
+            parts.append(arg)
+            parts.append(b"\r\n")
+        return b"".join(parts)
+
+    async def _read_reply(self, reader):
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("Connection closed by the KV server.")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise KVError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            return (await reader.readexactly(length + 2))[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply(reader) for _ in range(length)]
+        raise KVError(f"Unexpected reply from the KV server: {line!r}")
+
+    async def _connect(self):
+        reader, writer = await asyncio.open_connection(self._host, self._port)
+        for command in (
+            (["AUTH", self._password] if self._password else None),
+            (["SELECT", self._db] if self._db else None),
+        ):
+            if command:
+                writer.write(self._pack(command))
+                await writer.drain()
+                await self._read_reply(reader)
+        return reader, writer
+
+    async def execute(self, *args):
+        async with self._semaphore:
+            reader, writer = self._idle.pop() if self._idle else await self._connect()
+            try:
+                writer.write(self._pack(args))
+                await writer.drain()
+                reply = await self._read_reply(reader)
+            except KVError:
+                self._idle.append((reader, writer))
+                raise
+            except BaseException:
+                # The connection is in an unknown state, drop it.
+                writer.close()
+                raise
+            self._idle.append((reader, writer))
+            return reply
+
+    async def aget(self, key: str):
+        data = await self.execute("GET", key)
+        if data is None:
+            raise KeyError(key)
+        v = _decode_value(data)
+        if v is None:
+            raise KeyError(key)
+        return v
+
+    async def aput(self, key: str, value, ttl: float = None):
+        ttl = self._ttl if ttl is None else ttl
+        if ttl:
+            await self.execute("SET", key, _encode_value(value), "PX", int(ttl * 1000))
+        else:
+            await self.execute("SET", key, _encode_value(value))
+
+    async def aappend_turn(self, search_uuid: str, turn: dict):
+        turn = dict(turn)
+        search_results = turn.pop("search_results", None)
+        if search_results:
+            turn["results_hash"] = _results_hash(search_results)
+            results_key = f"results:{turn['results_hash']}"
+            if self._ttl:
+                await self.execute("SET", results_key, _encode_value(search_results), "EX", int(self._ttl))
+            else:
+                await self.execute("SET", results_key, _encode_value(search_results))
+        turns_key = f"{search_uuid}_turns"
+        await self.execute("RPUSH", turns_key, _encode_value(turn))
+        if self._ttl:
+            await self.execute("EXPIRE", turns_key, int(self._ttl))
+
+    async def aget_history(self, search_uuid: str, limit: int = MAX_HISTORY_LEN):
+        turns = [
+            _decode_value(data)
+            for data in await self.execute("LRANGE", f"{search_uuid}_turns", -limit, -1)
+        ]
+        hashes = list({t["results_hash"] for t in turns if t.get("results_hash")})
+        results = {}
+        if hashes:
+            values = await self.execute("MGET", *[f"results:{h}" for h in hashes])
+            results = {h: _decode_value(v) for h, v in zip(hashes, values) if v is not None}
+        for turn in turns:
+            turn["search_results"] = results.get(turn.pop("results_hash", None))
+        return turns
+
+    async def aclose(self):
+        while self._idle:
+            _, writer = self._idle.pop()
+            writer.close()
+
+
+def create_kv(executor=None) -> KVBackend:
+    """
+    Creates the KV backend picked with KV_BACKEND: SQLITE (default), LMDB or
+    REDIS. Its blocking calls run in `executor`.
+    """
+    backend = (os.getenv("KV_BACKEND") or "SQLITE").upper()
+    if backend == "SQLITE":
+        kv = KVWrapper(os.getenv("KV_NAME") or "search.db")
+    elif backend == "LMDB":
+        kv = LMDBKV(os.getenv("KV_NAME") or "search.lmdb")
+    elif backend == "REDIS":
+        kv = RedisKV(os.getenv("REDIS_URL") or "redis://localhost:6379/0")
     else:
-        search_results, llm_response, related_questions = None, None, None
-    
-    return search_results, llm_response, related_questions
+        raise RuntimeError("KV_BACKEND must be SQLITE, LMDB or REDIS.")
+    kv.executor = executor
+    return kv
+
+
+def normalize_query(query: str) -> str:
+    """
+    Normalizes the query text so that trivially different spellings of the same
+    question share cache entries.
+    """
+    query = unicodedata.normalize("NFKC", query).casefold()
+    query = re.sub(r"\s+", " ", query)
+    return query.strip(" ?!.。？！'\"")
+
+
+class TTLCache(object):
+    """
+    An in-memory LRU cache whose entries are fresh for `ttl` seconds and may be
+    served stale for `stale_ttl` more seconds.
+    """
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float = 0):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._stale_ttl = stale_ttl
+        self._data = OrderedDict()
+
+    def get(self, key):
+        """
+        Returns a `(value, is_stale)` tuple, or None if there is no usable entry.
+        """
+        entry = self._data.get(key)
+        if entry is None:
+            return None
+        value, stored_at = entry
+        age = time.monotonic() - stored_at
+        if age > self._ttl + self._stale_ttl:
+            del self._data[key]
+            return None
+        self._data.move_to_end(key)
+        return value, age > self._ttl
+
+    def put(self, key, value):
+        self._data[key] = (value, time.monotonic())
+        self._data.move_to_end(key)
+        while len(self._data) > self._maxsize:
+            self._data.popitem(last=False)
+
+    def __len__(self):
+        return len(self._data)
+
+
+class Metrics(Counter):
+    """
+    The counters, histograms and gauges of one worker, rendered in the
+    Prometheus text format on /metrics. Counters are used like a Counter of
+    names; `inc` and `observe` take labels.
+    """
+    def __init__(self, buckets=METRICS_BUCKETS):
+        super().__init__()
+        self._buckets = buckets
+        # (name, labels) -> [bucket counts..., sum, count]
+        self.histograms = {}
+        self.gauges = {}
+
+    @staticmethod
+    def _series(name: str, labels: dict) -> str:
+        if not labels:
+            return name
+        return name + "{" + ",".join(f'{k}="{v}"' for k, v in sorted(labels.items())) + "}"
+
+    def inc(self, name: str, value: float = 1, **labels):
+        self[self._series(name, labels)] += value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        histogram = self.histograms.get(key)
+        if histogram is None:
+            histogram = self.histograms[key] = [0] * (len(self._buckets) + 2)
+        for i, bound in enumerate(self._buckets):
+            if seconds <= bound:
+                histogram[i] += 1
+        histogram[-2] += seconds
+        histogram[-1] += 1
+
+    def gauge(self, name: str, function):
+        """ Registers a gauge, read by calling `function` on every scrape. """
+        self.gauges[name] = function
+
+    def render(self, prefix: str = "search4all_") -> str:
+        lines = []
+        typed = set()
+
+        def _type(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {prefix}{name} {kind}")
+
+        for series in sorted(self):
+            name = series.split("{", 1)[0]
+            _type(f"{name}_total", "counter")
+            lines.append(f"{prefix}{name}_total{series[len(name):]} {self[series]}")
+        for (name, labels), histogram in sorted(self.histograms.items()):
+            _type(name, "histogram")
+            labels = dict(labels)
+            for bound, count in zip(self._buckets, histogram):
+                lines.append(f"{prefix}{self._series(name + '_bucket', dict(labels, le=bound))} {count}")
+            inf_labels = dict(labels, le="+Inf")
+            lines.append(f"{prefix}{self._series(name + '_bucket', inf_labels)} {histogram[-1]}")
+            lines.append(f"{prefix}{self._series(name + '_sum', labels)} {histogram[-2]}")
+            lines.append(f"{prefix}{self._series(name + '_count', labels)} {histogram[-1]}")
+        for name, function in sorted(self.gauges.items()):
+            _type(name, "gauge")
+            lines.append(f"{prefix}{name} {function()}")
+        return "\n".join(lines) + "\n"
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    About one token per CJK character and per four other characters.
+    """
+    cjk = len(re.findall(r"[\u3040-\u30ff\u3400-\u9fff\uac00-\ud7af]", text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def create_token_counter():
+    """
+    Returns a function that counts the tokens of a text.
+    """
+    if tiktoken is not None:
+        try:
+            encoding = tiktoken.get_encoding("cl100k_base")
+            return lambda text: len(encoding.encode(text, disallowed_special=()))
+        except Exception as e:
+            logger.warning(f"tiktoken is not usable ({e}), estimating tokens instead.")
+    return estimate_tokens
+
+
+def _shingles(text: str) -> set:
+    words = re.findall(r"\w+", text.lower())
+    if len(words) < 3:
+        return set(words)
+    return {" ".join(words[i:i + 3]) for i in range(len(words) - 2)}
+
+
+def pack_contexts(contexts, query: str, budget: int, count_tokens=estimate_tokens):
+    """
+    Selects the texts of the contexts that go into the prompt, as a list of
+    `(citation_number, text)` in the original order. The citation numbers are
+    the positions in `contexts`, so that they still match the sources sent to
+    the client when some contexts are left out.
+
+    Near-duplicates of a better ranked context are dropped, then the contexts
+    are taken by relevance - the query words they contain, then their search
+    rank - as long as they fit in the token budget.
+    """
+    candidates = []
+    kept_shingles = []
+    for i, c in enumerate(contexts):
+        text = c.get("content") or c.get("snippet") or ""
+        shingles = _shingles(text)
+        if not shingles or any(
+            len(shingles & other) / len(shingles | other) >= CONTEXT_DUPLICATE_SIMILARITY
+            for other in kept_shingles
+        ):
+            continue
+        kept_shingles.append(shingles)
+        candidates.append((i + 1, text))
+
+    terms = set(re.findall(r"\w+", normalize_query(query)))
+
+    def _relevance(candidate):
+        number, text = candidate
+        words = set(re.findall(r"\w+", text.lower()))
+        overlap = len(terms & words) / len(terms) if terms else 0
+        return overlap + 1 / (number + 1)
+
+    packed = []
+    remaining = budget
+    for number, text in sorted(candidates, key=_relevance, reverse=True):
+        tokens = count_tokens(text)
+        if tokens > remaining:
+            if remaining < PROMPT_MIN_CONTEXT_TOKENS:
+                continue
+            text = text[:len(text) * remaining // tokens]
+            tokens = count_tokens(text)
+        packed.append((number, text))
+        remaining -= tokens
+    if len(packed) < len(contexts):
+        logger.info(
+            f"Packed {len(packed)}/{len(contexts)} contexts in {budget - remaining} tokens."
+        )
+    return sorted(packed)
 
-def search_with_search1api(query: str, search1api_key: str):
-    """Search with bing and return the contexts."""
+
+def trim_chat_history(chat_history, budget: int, count_tokens=estimate_tokens):
+    """
+    Keeps the most recent question and answer pairs of the chat history that
+    fit in the token budget.
+    """
+    kept = []
+    remaining = budget
+    for end in range(len(chat_history), 0, -2):
+        pair = chat_history[max(0, end - 2):end]
+        tokens = sum(count_tokens(m["content"] or "") for m in pair)
+        if tokens > remaining:
+            break
+        kept[:0] = pair
+        remaining -= tokens
+    return kept
+
+
+class SemanticCache(object):
+    """
+    An in-memory LRU cache of answers looked up by query similarity.
+
+    Only the entries with the same key words as the query - its words and
+    numbers in order, without the stop words - are candidates. Among them, a
+    query is mapped, without any model or network call, to a sparse vector of
+    hashed word and character trigram counts, normalized to unit length.
+    """
+    def __init__(self, maxsize: int, ttl: float, threshold: float,
+                 dims: int = SEMANTIC_CACHE_DIMS):
+        self._maxsize = maxsize
+        self._ttl = ttl
+        self._threshold = threshold
+        self._dims = dims
+        # key -> (key words, vector, value, stored_at)
+        self._entries = OrderedDict()
+        # key words -> keys of the entries that have them
+        self._groups = {}
+
+    @staticmethod
+    def _text(query: str) -> str:
+        text = re.sub(r"[^\w\s]", " ", normalize_query(query))
+        return " ".join(text.split())
+
+    def key_words(self, query: str) -> tuple:
+        """ The words that two queries must share, in the same order, to match. """
+        return tuple(w for w in self._text(query).split() if w not in SEMANTIC_CACHE_STOPWORDS)
+
+    def vectorize(self, query: str) -> dict:
+        text = self._text(query)
+        features = [f"w:{w}" for w in text.split()]
+        padded = f" {text} "
+        features += [f"c:{padded[i:i + 3]}" for i in range(len(padded) - 2)]
+        vector = {}
+        for feature in features:
+            index = zlib.crc32(feature.encode()) % self._dims
+            vector[index] = vector.get(index, 0.0) + 1.0
+        norm = sum(v * v for v in vector.values()) ** 0.5 or 1.0
+        return {k: v / norm for k, v in vector.items()}
+
+    def get(self, query: str):
+        """
+        Returns `(value, similarity)` of the most similar fresh entry above the
+        threshold, or None.
+        """
+        candidates = self._groups.get(self.key_words(query))
+        if not candidates:
+            return None
+        vector = self.vectorize(query)
+        best, best_similarity = None, self._threshold
+        now = time.monotonic()
+        for key in candidates:
+            _, other, _, stored_at = self._entries[key]
+            if now - stored_at > self._ttl:
+                continue
+            similarity = sum(w * other.get(i, 0.0) for i, w in vector.items())
+            if similarity >= best_similarity:
+                best, best_similarity = key, similarity
+        if best is None:
+            return None
+        self._entries.move_to_end(best)
+        return self._entries[best][2], best_similarity
+
+    def put(self, query: str, value):
+        key = normalize_query(query)
+        self._remove(key)
+        words = self.key_words(query)
+        self._entries[key] = (words, self.vectorize(query), value, time.monotonic())
+        self._groups.setdefault(words, set()).add(key)
+        while len(self._entries) > self._maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        keys = self._groups[entry[0]]
+        keys.discard(key)
+        if not keys:
+            del self._groups[entry[0]]
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class Overloaded(Exception):
+    """ Raised when a stage has no free slot and its wait queue is full. """
+
+
+class AdmissionGate(object):
+    """
+    Bounds the number of concurrent runs of one stage. Callers beyond `limit`
+    wait in a queue of at most `max_waiting`, for at most `max_wait` seconds;
+    the others are rejected with Overloaded instead of piling up.
+    """
+    def __init__(self, name: str, limit: int, max_waiting: int, max_wait: float,
+                 metrics: Metrics = None):
+        self.name = name
+        self.limit = limit
+        self.active = 0
+        self.waiting = 0
+        self._max_waiting = max_waiting
+        self._max_wait = max_wait if max_wait > 0 else None
+        self._semaphore = asyncio.Semaphore(limit) if limit > 0 else None
+        self._metrics = metrics if metrics is not None else Metrics()
+
+    def _reject(self, reason: str):
+        self._metrics.inc("admission_rejected", stage=self.name)
+        raise Overloaded(f"Too many {self.name} requests: {reason}.")
+
+    def check(self):
+        """ Raises Overloaded if `acquire` would be rejected right away. """
+        if self._semaphore is None:
+            return
+        if self.active + self.waiting >= self.limit + self._max_waiting:
+            self._reject("the queue is full")
+
+    async def acquire(self) -> float:
+        """ Waits for a slot and returns the seconds spent waiting. """
+        if self._semaphore is None:
+            return 0
+        self.check()
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self._semaphore.acquire(), self._max_wait)
+        except asyncio.TimeoutError:
+            self._reject(f"waited {self._max_wait}s")
+        finally:
+            self.waiting -= 1
+        self.active += 1
+        waited = time.monotonic() - start
+        self._metrics.observe("admission_wait_seconds", waited, stage=self.name)
+        return waited
+
+    async def acquire_nowait(self):
+        """ Takes a free slot, or raises Overloaded right away if there is none. """
+        if self._semaphore is None:
+            return
+        if self._semaphore.locked():
+            self._reject("no free slot")
+        # There is a free slot and nobody waits for it, this does not suspend.
+        await self._semaphore.acquire()
+        self.active += 1
+
+    def release(self):
+        if self._semaphore is None:
+            return
+        self.active -= 1
+        self._semaphore.release()
+
+    def wrap(self, function):
+        """ Runs `function` in a slot of this gate. """
+        async def admitted(*args, **kwargs):
+            async with self:
+                return await function(*args, **kwargs)
+        return admitted
+
+    async def __aenter__(self):
+        await self.acquire()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.release()
+
+
+class SearchCache(object):
+    """
+    Caches search results by backend and normalized query, with
+    stale-while-revalidate: a stale entry is returned immediately and refreshed
+    by a background task.
+    """
+    def __init__(self, maxsize: int, ttl: float, stale_ttl: float, metrics: Metrics = None):
+        self._cache = TTLCache(maxsize, ttl, stale_ttl)
+        self._enabled = ttl > 0 and maxsize > 0
+        self._refreshing = {}
+        self._metrics = metrics if metrics is not None else Metrics()
+
+    async def search(self, backend: str, query: str, search_function):
+        key = (backend, normalize_query(query))
+        if self._enabled:
+            cached = self._cache.get(key)
+            if cached is not None:
+                contexts, is_stale = cached
+                if is_stale and key not in self._refreshing:
+                    self._refreshing[key] = asyncio.create_task(
+                        self._refresh(key, query, search_function)
+                    )
+                logger.info(f"Search cache hit for {key} (stale: {is_stale}).")
+                self._metrics.inc("cache_requests", layer="search", result="stale" if is_stale else "hit")
+                return list(contexts)
+            self._metrics.inc("cache_requests", layer="search", result="miss")
+        try:
+            contexts = await search_function(query)
+        except SearchUnavailable as e:
+            # Answer without sources rather than wait on a broken backend.
+            logger.warning(f"{e} Answering {key} without search results.")
+            return []
+        if contexts and self._enabled:
+            self._cache.put(key, list(contexts))
+        return contexts
+
+    async def _refresh(self, key, query, search_function):
+        try:
+            contexts = await search_function(query)
+            if contexts:
+                self._cache.put(key, list(contexts))
+        except Exception as e:
+            logger.error(f"Failed to refresh search cache for {key}: {e}")
+        finally:
+            self._refreshing.pop(key, None)
+
+
+class StreamWriter(object):
+    """
+    Writes a streamed response in frames. Deltas are buffered and sent
+    together once `interval` seconds have passed since the last frame or
+    `max_bytes` characters are buffered; a delta that comes after a pause is
+    sent right away, so the time to first token does not change.
+    """
+    def __init__(self, response, interval: float = STREAM_FLUSH_INTERVAL,
+                 max_bytes: int = STREAM_FLUSH_BYTES):
+        self._response = response
+        self._interval = interval
+        self._max_bytes = max_bytes
+        self._buffer = []
+        self._size = 0
+        self._last_flush = 0
+
+    def flush_in(self):
+        """
+        Seconds until the buffered deltas are due, or None if there are none.
+        """
+        if not self._buffer:
+            return None
+        return max(0, self._last_flush + self._interval - time.monotonic())
+
+    async def write(self, text: str):
+        if not text:
+            return
+        self._buffer.append(text)
+        self._size += len(text)
+        if self._size >= self._max_bytes or self.flush_in() == 0:
+            await self.flush()
+
+    async def flush(self):
+        if not self._buffer:
+            return
+        frame = "".join(self._buffer)
+        self._buffer = []
+        self._size = 0
+        self._last_flush = time.monotonic()
+        await self._response.send(frame)
+
+
+class StreamBroadcast(object):
+    """
+    Fans out the events of one generation to any number of responses. All the
+    events are kept, so a subscriber that attaches late replays them from the
+    start before following the live tail.
+
+    The events are `(type, data)` tuples: `("sources", contexts)`, then one
+    `("delta", text)` per piece of the answer, `("related", questions)` and
+    `("done", None)`. The answer is also built up in structured fields while
+    streaming, so that it can be stored without parsing the response again.
+    """
+    def __init__(self):
+        self.events = []
+        self.contexts = None
+        self.related_questions = None
+        self._answer = []
+        self.done = False
+        self.error = None
+        self.task = None
+        self.subscribers = 0
+        # The search_uuids the result has been stored for.
+        self.stored = set()
+        self._cancel_handle = None
+        # Seconds spent in the stages of the generation, for Server-Timing.
+        self.timings = {}
+        # Number of answer deltas generated so far.
+        self.answer_deltas = 0
+        self._changed = asyncio.Event()
+
+    def publish(self, event_type: str, data=None):
+        if event_type == "sources":
+            self.contexts = data
+        elif event_type == "delta":
+            self._answer.append(data)
+        elif event_type == "related":
+            self.related_questions = data
+        self.events.append((event_type, data))
+        self._wake()
+
+    @property
+    def answer(self) -> str:
+        if len(self._answer) > 1:
+            self._answer = ["".join(self._answer)]
+        return self._answer[0] if self._answer else ""
+
+    def result(self) -> dict:
+        """ The generation so far, in the shape it is stored in the KV. """
+        return {
+            "contexts": self.contexts,
+            "answer": self.answer,
+            "related_questions": self.related_questions,
+        }
+
+    def close(self, error: Exception = None):
+        self.done = True
+        self.error = error
+        self._wake()
+
+    def _wake(self):
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def subscribe(self) -> AsyncGenerator[tuple, None]:
+        """
+        Replays then follows the events. When the last subscriber leaves
+        before the end, nobody is reading anymore and the generation task is
+        cancelled, unless a subscriber comes back within STREAM_GRACE_PERIOD.
+        """
+        i = 0
+        self.subscribers += 1
+        if self._cancel_handle is not None:
+            self._cancel_handle.cancel()
+            self._cancel_handle = None
+        try:
+            while True:
+                while i < len(self.events):
+                    yield self.events[i]
+                    i += 1
+                if self.done:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                await self._changed.wait()
+        finally:
+            self.subscribers -= 1
+            if self.subscribers == 0 and not self.done and self.task is not None:
+                self._cancel_handle = asyncio.get_running_loop().call_later(
+                    STREAM_GRACE_PERIOD, self._cancel_unobserved
+                )
+
+    def _cancel_unobserved(self):
+        self._cancel_handle = None
+        if self.subscribers == 0 and not self.done:
+            self.task.cancel()
+
+
+# The wire formats of /query and their content types. "raw" is the original
+# format read by the web UI: the contexts JSON, the __LLM_RESPONSE__ marker,
+# the answer, the __RELATED_QUESTIONS__ marker and the related questions JSON,
+# all concatenated. "ndjson" and "sse" send one typed event per line / per
+# server-sent event instead.
+STREAM_FORMATS = {
+    "raw": "text/html",
+    "ndjson": "application/x-ndjson",
+    "sse": "text/event-stream",
+}
+
+
+def get_stream_format(request, params) -> str:
+    """
+    The wire format asked for with the `stream_format` field or the Accept
+    header, "raw" by default.
+    """
+    stream_format = params.get("stream_format")
+    if stream_format in STREAM_FORMATS:
+        return stream_format
+    accept = request.headers.get("accept", "")
+    for name, content_type in STREAM_FORMATS.items():
+        if name != "raw" and content_type in accept:
+            return name
+    return "raw"
+
+
+def render_event(event_type: str, data, stream_format: str) -> str:
+    if stream_format == "ndjson":
+        return json.dumps({"type": event_type, "data": data}) + "\n"
+    if stream_format == "sse":
+        return f"event: {event_type}\ndata: {json.dumps(data)}\n\n"
+    if event_type == "sources":
+        return json.dumps(data) + "\n\n__LLM_RESPONSE__\n\n"
+    if event_type == "delta":
+        return data
+    if event_type == "related":
+        return "\n\n__RELATED_QUESTIONS__\n\n" + json.dumps(data)
+    if event_type == "error":
+        return "\n\n__ERROR__\n\n" + json.dumps(data)
+    return ""
+
+
+def result_events(result: dict):
+    """ The events of a stored or partial result. """
+    events = []
+    if result.get("contexts") is not None:
+        events.append(("sources", result["contexts"]))
+    if result.get("answer"):
+        events.append(("delta", result["answer"]))
+    if result.get("related_questions") is not None:
+        events.append(("related", result["related_questions"]))
+    return events
+
+
+def legacy_result(txt: str) -> dict:
+    """
+    Splits the raw response text of a result stored before the typed events
+    back into its contexts, answer and related questions.
+    """
+    contexts, _, rest = txt.partition("__LLM_RESPONSE__")
+    answer, _, related_questions = rest.partition("__RELATED_QUESTIONS__")
+    try:
+        contexts = json.loads(contexts)
+    except ValueError:
+        contexts = None
+    try:
+        related_questions = json.loads(related_questions)
+    except ValueError:
+        related_questions = None
+    return {
+        "contexts": contexts,
+        "answer": answer.strip(),
+        "related_questions": related_questions,
+    }
+
+
+def render_result(result: dict, stream_format: str) -> str:
+    """
+    Renders a stored result. Results stored before the typed events only have
+    the raw response text, which is sent as is or split into events.
+    """
+    if "txt" in result:
+        if stream_format == "raw":
+            return result["txt"]
+        result = legacy_result(result["txt"])
+    events = result_events(result) + [("done", None)]
+    return "".join(render_event(t, d, stream_format) for t, d in events)
+
+
+class SearchEngineError(HTTPException):
+    """ A search backend call failed, with the HTTP status it answered if any. """
+    def __init__(self, status_code: int = None):
+        super().__init__("Search engine error.")
+        self.upstream_status = status_code
+
+
+def is_retryable(error: Exception) -> bool:
+    """
+    Whether a failed search call may succeed if retried: timeouts, connection
+    errors, 429 and 5xx. Other errors, like a 401 or a 400, would fail again.
+    """
+    status = getattr(error, "upstream_status", None)
+    if isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+    if status is not None:
+        return status == 429 or status >= 500
+    if error.__cause__ is not None:
+        return is_retryable(error.__cause__)
+    return isinstance(error, (asyncio.TimeoutError, httpx.TransportError, ConnectionError))
+
+
+async def search_with_search1api(client: httpx.AsyncClient, query: str, search1api_key: str):
+    """Search with search1api and return the contexts."""
     payload = {
         "max_results": 10,
         "query": query,
@@ -153,10 +1669,15 @@ def search_with_search1api(query: str, search1api_key: str):
         "Authorization": f"Bearer {search1api_key}",
         "Content-Type": "application/json"
     }
-    response = requests.request("POST", SEARCH1API_SEARCH_ENDPOINT, json=payload, headers=headers)
-    if not response.ok:
+    response = await client.post(
+        SEARCH1API_SEARCH_ENDPOINT,
+        json=payload,
+        headers=headers,
+        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
+    )
+    if not response.is_success:
         logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException("Search engine error.")
+        raise SearchEngineError(response.status_code)
     
     json_content = response.json()
     try:
@@ -169,20 +1690,20 @@ def search_with_search1api(query: str, search1api_key: str):
         return []
     
     return contexts
-def search_with_bing(query: str, subscription_key: str):
+async def search_with_bing(client: httpx.AsyncClient, query: str, subscription_key: str):
     """
     Search with bing and return the contexts.
     """
     params = {"q": query, "mkt": BING_MKT}
-    response = requests.get(
+    response = await client.get(
         BING_SEARCH_V7_ENDPOINT,
         headers={"Ocp-Apim-Subscription-Key": subscription_key},
         params=params,
         timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
     )
-    if not response.ok:
+    if not response.is_success:
         logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException("Search engine error.")
+        raise SearchEngineError(response.status_code)
     json_content = response.json()
     try:
         contexts = json_content["webPages"]["value"][:REFERENCE_COUNT]
@@ -192,7 +1713,7 @@ def search_with_bing(query: str, subscription_key: str):
     return contexts
 
 
-def search_with_google(query: str, subscription_key: str, cx: str):
+async def search_with_google(client: httpx.AsyncClient, query: str, subscription_key: str, cx: str):
     """
     Search with google and return the contexts.
     """
@@ -202,12 +1723,12 @@ def search_with_google(query: str, subscription_key: str, cx: str):
         "q": query,
         "num": REFERENCE_COUNT,
     }
-    response = requests.get(
+    response = await client.get(
         GOOGLE_SEARCH_ENDPOINT, params=params, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
     )
-    if not response.ok:
+    if not response.is_success:
         logger.error(f"{response.status_code} {response.text}")
-        raise HTTPException("Search engine error.")
+        raise SearchEngineError(response.status_code)
     json_content = response.json()
     try:
         contexts = json_content["items"][:REFERENCE_COUNT]
@@ -219,7 +1740,41 @@ def search_with_google(query: str, subscription_key: str, cx: str):
         return []
     return contexts
 
-def search_with_serpapi(query: str, api_key: str):
+
+async def search_with_serper(client: httpx.AsyncClient, query: str, subscription_key: str):
+    """
+    Search with serper and return the contexts.
+    """
+    payload = {
+        "q": query,
+        "num": REFERENCE_COUNT,
+    }
+    headers = {
+        "X-API-KEY": subscription_key,
+        "Content-Type": "application/json",
+    }
+    response = await client.post(
+        SERPER_SEARCH_ENDPOINT,
+        json=payload,
+        headers=headers,
+        timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
+    )
+    if not response.is_success:
+        logger.error(f"{response.status_code} {response.text}")
+        raise SearchEngineError(response.status_code)
+    json_content = response.json()
+    try:
+        contexts = [
+            {"name": c["title"], "url": c["link"], "snippet": c.get("snippet", "")}
+            for c in json_content["organic"]
+        ]
+    except KeyError:
+        logger.error(f"Error encountered: {json_content}")
+        return []
+    return contexts[:REFERENCE_COUNT]
+
+
+async def search_with_serpapi(client: httpx.AsyncClient, query: str, api_key: str):
     """
     Search with serpapi and return the contexts.
     """
@@ -228,9 +1783,12 @@ def search_with_serpapi(query: str, api_key: str):
         "q": query,
         "api_key": api_key,
     }
-    search = GoogleSearch(params)
     try:
-        results = search.get_dict()
+        response = await client.get(
+            SERPAPI_SEARCH_ENDPOINT, params=params, timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT
+        )
+        response.raise_for_status()
+        results = response.json()
         organic_results = results.get("organic_results", [])
         contexts = [
             {"name": c["title"], "url": c["link"], "snippet": c.get("snippet", "")}
@@ -239,31 +1797,271 @@ def search_with_serpapi(query: str, api_key: str):
         return contexts[:REFERENCE_COUNT]
     except Exception as e:
         logger.error(f"Serpapi error: {e}")
-        raise HTTPException("Search engine error.")
+        raise SearchEngineError() from e
 
 
-def extract_url_content(url):
-    logger.info(url)
-    downloaded = trafilatura.fetch_url(url)
-    content =  trafilatura.extract(downloaded)
-
-    logger.info(url +"______"+  content)
+def extract_url_content(url, downloaded=None):
+    """
+    Extracts the main text of a page, downloading it first if `downloaded` is
+    not given. It is CPU heavy and may run in a process pool, so it must stay
+    a module level function.
+    """
+    if downloaded is None:
+        downloaded = trafilatura.fetch_url(url)
+    content = None
+    if downloaded:
+        extracted = bare_extraction(downloaded, url=url, include_comments=False)
+        if extracted:
+            content = extracted.get("text")
     return {"url":url, "content":content}
 
 
+def create_extraction_pool(max_workers: int):
+    """
+    The pool the page text is extracted in. Daemon processes cannot start
+    children, and the Sanic workers are daemons, so there the extraction runs
+    in threads; elsewhere it runs in a process pool.
+    """
+    if multiprocessing.current_process().daemon:
+        return concurrent.futures.ThreadPoolExecutor(
+            max_workers=max_workers, thread_name_prefix="extract"
+        )
+    return concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+
+
+def executor_queue_depth(executor) -> int:
+    """ Number of jobs submitted to a thread or process pool and not started yet. """
+    if isinstance(executor, concurrent.futures.ProcessPoolExecutor):
+        return len(executor._pending_work_items)
+    return executor._work_queue.qsize()
+
+
+class ContentCache(object):
+    """
+    A size bounded on-disk cache of extracted page contents, keyed by URL. The
+    least recently used pages are evicted first. All the methods are blocking
+    and should be run in the executor.
+    """
+    def __init__(self, filename: str, max_bytes: int):
+        self._max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS pages (url TEXT PRIMARY KEY, content BLOB,"
+            " etag TEXT, last_modified TEXT, fetched_at REAL, accessed_at REAL, size INTEGER)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS pages_accessed_at ON pages (accessed_at)"
+        )
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def get(self, url: str):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT content, etag, last_modified, fetched_at FROM pages WHERE url = ?",
+                (url,),
+            ).fetchone()
+            if row is None:
+                return None
+            self._conn.execute(
+                "UPDATE pages SET accessed_at = ? WHERE url = ?", (time.time(), url)
+            )
+        return {
+            "content": zlib.decompress(row[0]).decode(),
+            "etag": row[1],
+            "last_modified": row[2],
+            "fetched_at": row[3],
+        }
+
+    def put(self, url: str, content: str, etag: str = None, last_modified: str = None):
+        data = zlib.compress(content.encode())
+        now = time.time()
+        with self._lock:
+            old = self._conn.execute("SELECT size FROM pages WHERE url = ?", (url,)).fetchone()
+            self._conn.execute(
+                "INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (url, data, etag, last_modified, now, now, len(data)),
+            )
+            self._size += len(data) - (old[0] if old else 0)
+            if self._size > self._max_bytes:
+                self._evict()
+
+    def revalidated(self, url: str):
+        """ Marks a page as fresh again after a 304 Not Modified. """
+        with self._lock:
+            now = time.time()
+            self._conn.execute(
+                "UPDATE pages SET fetched_at = ?, accessed_at = ? WHERE url = ?",
+                (now, now, url),
+            )
+
+    def _evict(self):
+        # Drop the least recently used pages until 90% of the budget is left,
+        # so that eviction does not run again on the next put.
+        while self._size > self._max_bytes * 0.9:
+            rows = self._conn.execute(
+                "SELECT url, size FROM pages ORDER BY accessed_at LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            evicted = []
+            for url, size in rows:
+                evicted.append((url,))
+                self._size -= size
+                if self._size <= self._max_bytes * 0.9:
+                    break
+            self._conn.executemany("DELETE FROM pages WHERE url = ?", evicted)
+        self._size = self._conn.execute("SELECT COALESCE(SUM(size), 0) FROM pages").fetchone()[0]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+class ContentEnricher(object):
+    """
+    Fetches the full pages of the search results and extracts their text.
+
+    Pages are fetched concurrently on the pooled http client, bounded both
+    globally and per host. Whatever is not ready by the deadline keeps its
+    search engine snippet.
+    """
+    def __init__(self, client: httpx.AsyncClient, extraction_pool, deadline: float,
+                 max_concurrency: int, max_per_host: int,
+                 content_cache: ContentCache = None, executor=None, metrics: Metrics = None):
+        self._client = client
+        self._metrics = metrics if metrics is not None else Metrics()
+        self._extraction_pool = extraction_pool
+        self._content_cache = content_cache
+        self._executor = executor
+        self._deadline = deadline
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        self._max_per_host = max_per_host
+        self._host_semaphores = weakref.WeakValueDictionary()
+
+    async def enrich(self, contexts):
+        """
+        Returns a copy of the contexts where each page that could be extracted
+        in time carries its text in the `content` field.
+        """
+        tasks = [
+            asyncio.create_task(self._fetch_content(c["url"])) if c.get("url") else None
+            for c in contexts
+        ]
+        pending = [t for t in tasks if t is not None]
+        if not pending:
+            return contexts
+        try:
+            await asyncio.wait(pending, timeout=self._deadline)
+        finally:
+            # Also stops the fetches when the generation is cancelled.
+            for task in pending:
+                task.cancel()
+        enriched = []
+        extracted = 0
+        for c, task in zip(contexts, tasks):
+            content = None
+            if task is not None and task.done() and not task.cancelled():
+                if task.exception() is not None:
+                    logger.warning(f"Failed to extract {c['url']}: {task.exception()!r}")
+                else:
+                    content = task.result()
+            if content:
+                extracted += 1
+            enriched.append(dict(c, content=content[:FULL_CONTENT_MAX_CHARS]) if content else c)
+        logger.info(f"Extracted {extracted}/{len(pending)} pages before the deadline.")
+        return enriched
+
+    def _host_semaphore(self, host: str):
+        semaphore = self._host_semaphores.get(host)
+        if semaphore is None:
+            semaphore = asyncio.Semaphore(self._max_per_host)
+            self._host_semaphores[host] = semaphore
+        return semaphore
+
+    async def _fetch_content(self, url: str):
+        loop = asyncio.get_running_loop()
+        cached = None
+        headers = {}
+        if self._content_cache is not None:
+            cached = await loop.run_in_executor(self._executor, self._content_cache.get, url)
+        if cached is not None:
+            if time.time() - cached["fetched_at"] < CONTENT_CACHE_FRESH_TTL:
+                self._metrics.inc("cache_requests", layer="content", result="hit")
+                return cached["content"]
+            if cached["etag"]:
+                headers["If-None-Match"] = cached["etag"]
+            if cached["last_modified"]:
+                headers["If-Modified-Since"] = cached["last_modified"]
+        # The host slot is taken first, so that the fetches waiting on a busy
+        # host do not hold global slots the other hosts could use.
+        host_semaphore = self._host_semaphore(urlparse(url).netloc)
+        async with host_semaphore, self._semaphore:
+            async with self._client.stream(
+                "GET", url, headers=headers, follow_redirects=True, timeout=self._deadline
+            ) as response:
+                html = await self._read_html(response)
+        if response.status_code == 304 and cached is not None:
+            self._metrics.inc("cache_requests", layer="content", result="revalidated")
+            _ = self._executor.submit(self._content_cache.revalidated, url)
+            return cached["content"]
+        if self._content_cache is not None:
+            self._metrics.inc("cache_requests", layer="content", result="miss")
+        if html is None:
+            return None
+        result = await loop.run_in_executor(
+            self._extraction_pool, extract_url_content, url, html
+        )
+        content = result["content"]
+        if content and self._content_cache is not None:
+            _ = self._executor.submit(
+                self._content_cache.put,
+                url,
+                content,
+                response.headers.get("etag"),
+                response.headers.get("last-modified"),
+            )
+        return content
+
+    @staticmethod
+    async def _read_html(response: httpx.Response):
+        """
+        Reads the first FULL_CONTENT_MAX_BYTES of an HTML page. Returns None,
+        without downloading the body, if the headers show that it is not an
+        HTML page or that it is larger.
+        """
+        if not response.is_success or "html" not in response.headers.get("content-type", ""):
+            return None
+        length = response.headers.get("content-length", "")
+        if length.isdigit() and int(length) > FULL_CONTENT_MAX_BYTES:
+            return None
+        body = bytearray()
+        async for chunk in response.aiter_bytes():
+            body += chunk
+            if len(body) >= FULL_CONTENT_MAX_BYTES:
+                break
+        try:
+            return body[:FULL_CONTENT_MAX_BYTES].decode(
+                response.charset_encoding or "utf-8", errors="replace"
+            )
+        except LookupError:
+            return body[:FULL_CONTENT_MAX_BYTES].decode("utf-8", errors="replace")
+
 
-def search_with_searXNG(query:str,url:str):
+async def search_with_searXNG(client: httpx.AsyncClient, query:str,url:str):
  
     content_list = []
 
     try:
         safe_string = urllib.parse.quote_plus(":auto " + query)
-        response = requests.get(url+'?q=' + safe_string + '&category=general&format=json&engines=bing%2Cgoogle')
+        response = await client.get(
+            url+'?q=' + safe_string + '&category=general&format=json&engines=bing%2Cgoogle',
+            timeout=DEFAULT_SEARCH_ENGINE_TIMEOUT,
+        )
         response.raise_for_status()
         search_results = response.json()
 
-        pedding_urls = []
-
         conv_links = []
 
         if search_results.get('results'):
@@ -271,7 +2069,6 @@ def search_with_searXNG(query:str,url:str):
                 name = item.get('title')
                 snippet = item.get('content')
                 url = item.get('url')
-                pedding_urls.append(url)
 
                 if url:
                     url_parsed = urlparse(url)
@@ -287,54 +2084,581 @@ def search_with_searXNG(query:str,url:str):
                     'url':url,
                     'snippet':snippet
                 })
-            results = []
-            futures = []
-
-            # executor = ThreadPoolExecutor(max_workers=10) 
-            # for url in pedding_urls:
-            #     futures.append(executor.submit(extract_url_content,url))
-            # try:
-            #     for future in futures:
-            #         res = future.result(timeout=5)
-            #         results.append(res)
-            # except concurrent.futures.TimeoutError:
-            #     logger.error("任务执行超时")
-            #     executor.shutdown(wait=False,cancel_futures=True)
-            # logger.info(results)
-            # for content in results:
-            #     if content and content.get('content'):
-                    
-            #         item_dict = {
-            #             "url":content.get('url'),
-            #             "name":content.get('url'),
-            #             "snippet":content.get('content'),
-            #             "content": content.get('content'),
-            #             "length":len(content.get('content'))
-            #         }
-            #         content_list.append(item_dict)
-            #     logger.info("URL: {}".format(url))
-            #     logger.info("=================")
-        if len(results)== 0 :
-            content_list = conv_links
+        content_list = conv_links
         return  content_list
     except Exception as ex:
-        logger.error(ex)
-        raise ex
+        logger.error(f"SearXNG error: {ex}")
+        raise SearchEngineError() from ex
+
+
+
+# Query parameters that only track the visitor and never change the page.
+TRACKING_PARAMS = ("utm_", "gclid", "fbclid", "msclkid", "ref", "spm")
+
+
+def canonical_url(url: str) -> str:
+    """
+    The URL used to recognize the same page returned by several engines.
+    """
+    parsed = urlparse(url.strip())
+    host = parsed.netloc.lower()
+    if host.startswith("www."):
+        host = host[4:]
+    query = "&".join(
+        sorted(
+            q for q in parsed.query.split("&")
+            if q and not q.lower().startswith(TRACKING_PARAMS)
+        )
+    )
+    path = parsed.path.rstrip("/")
+    return f"{host}{path}" + (f"?{query}" if query else "")
+
+
+class SearchUnavailable(Exception):
+    """ Raised without calling a search backend whose circuit is open. """
+
+
+class CircuitBreaker(object):
+    """
+    Stops calling a backend after `threshold` consecutive failures. After
+    `reset_timeout` seconds one call is let through (half-open): it closes the
+    circuit if it succeeds and opens it again if it fails.
+    """
+    def __init__(self, name: str, threshold: int = SEARCH_BREAKER_THRESHOLD,
+                 reset_timeout: float = SEARCH_BREAKER_RESET):
+        self.name = name
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return "closed"
+        if time.monotonic() - self.opened_at < self._reset_timeout or self._probing:
+            return "open"
+        return "half-open"
+
+    def allow(self) -> bool:
+        state = self.state
+        if state == "half-open":
+            self._probing = True
+        return state != "open"
+
+    def success(self):
+        self.failures = 0
+        self.opened_at = None
+        self._probing = False
+
+    def failure(self):
+        self.failures += 1
+        if self._probing or self.failures >= self._threshold:
+            if self.opened_at is None or self._probing:
+                logger.warning(f"Opening the circuit of search engine {self.name}.")
+            self.opened_at = time.monotonic()
+            self._probing = False
+
+    def abandon(self):
+        """
+        The probe call was cancelled, or failed in a way that says nothing
+        about the health of the backend: let the next call probe instead.
+        """
+        self._probing = False
+
+
+class RetryBudget(object):
+    """
+    Shared by all the backends: every call deposits `ratio` of a retry, and
+    `min_per_second` retries are added over time. A retry withdraws one; when
+    the budget is empty the call fails without retrying.
+    """
+    def __init__(self, ratio: float = SEARCH_RETRY_RATIO,
+                 min_per_second: float = SEARCH_RETRY_MIN_PER_SECOND, max_balance: float = 10):
+        self._ratio = ratio
+        self._min_per_second = min_per_second
+        self._max_balance = max_balance
+        self._balance = max_balance
+        self._updated_at = time.monotonic()
+
+    def _refill(self, amount: float):
+        now = time.monotonic()
+        amount += (now - self._updated_at) * self._min_per_second
+        self._updated_at = now
+        self._balance = min(self._max_balance, self._balance + amount)
+
+    def deposit(self):
+        self._refill(self._ratio)
+
+    def withdraw(self) -> bool:
+        self._refill(0)
+        if self._balance < 1:
+            return False
+        self._balance -= 1
+        return True
+
+
+class SearchEngine(object):
+    """
+    One search backend, with its latency and error rate, both exponentially
+    weighted, used to pick the engines to query.
+    """
+    def __init__(self, name: str, search_function, retry_budget: RetryBudget = None):
+        self.name = name
+        self.search_function = search_function
+        self.breaker = CircuitBreaker(name)
+        self.retry_budget = retry_budget or RetryBudget()
+        self.requests = 0
+        self.failures = 0
+        self.latency = None
+        self.error_rate = 0.0
+        self.last_request = 0
+
+    def record(self, latency: float, ok: bool):
+        self.requests += 1
+        self.last_request = time.monotonic()
+        if not ok:
+            self.failures += 1
+        self.error_rate = 0.7 * self.error_rate + 0.3 * (0.0 if ok else 1.0)
+        if ok:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+
+    @property
+    def score(self):
+        # Lower is better. Engines that were never queried go first, so that
+        # they get measured; a failing engine goes last, but is tried again
+        # after SEARCH_ENGINE_RETRY_AFTER seconds.
+        failing = (
+            self.error_rate > 0.5
+            and time.monotonic() - self.last_request < SEARCH_ENGINE_RETRY_AFTER
+        )
+        return (failing, self.latency or 0.0)
+
+    async def search(self, query: str):
+        """
+        Calls the backend within SEARCH_DEADLINE seconds, retrying the calls
+        that failed in a retryable way. Raises SearchUnavailable right away if
+        the circuit is open.
+        """
+        if not self.breaker.allow():
+            raise SearchUnavailable(f"Search engine {self.name} is unavailable.")
+        self.retry_budget.deposit()
+        deadline = time.monotonic() + SEARCH_DEADLINE
+        attempt = 0
+        while True:
+            start = time.monotonic()
+            try:
+                contexts = await asyncio.wait_for(
+                    self.search_function(query),
+                    min(DEFAULT_SEARCH_ENGINE_TIMEOUT, deadline - start),
+                )
+            except asyncio.CancelledError:
+                self.breaker.abandon()
+                raise
+            except Exception as e:
+                self.record(time.monotonic() - start, False)
+                if not is_retryable(e):
+                    # The backend answered, the call itself is wrong: fail
+                    # fast, without counting it against the circuit.
+                    self.breaker.abandon()
+                    raise
+                self.breaker.failure()
+                # Full jitter, so that the retries of concurrent searches
+                # do not hit the backend at the same moment.
+                backoff = random.uniform(0, SEARCH_RETRY_BACKOFF * 2 ** attempt)
+                if (
+                    attempt >= SEARCH_RETRIES
+                    or not self.breaker.allow()
+                    or time.monotonic() + backoff >= deadline
+                    or not self.retry_budget.withdraw()
+                ):
+                    raise
+                attempt += 1
+                logger.warning(f"Search engine {self.name} failed ({e!r}), retry {attempt}.")
+                await asyncio.sleep(backoff)
+                continue
+            self.record(time.monotonic() - start, True)
+            self.breaker.success()
+            return contexts
+
+
+class MetaSearch(object):
+    """
+    Queries several search engines concurrently. In race mode the first
+    non-empty response is returned and the other queries are cancelled; in
+    merge mode the responses that arrive within the deadline are merged by
+    canonical URL and ordered by reciprocal rank fusion.
+    """
+    def __init__(self, engines, mode: str = SEARCH_MODE, deadline: float = SEARCH_MERGE_DEADLINE,
+                 fanout: int = SEARCH_FANOUT):
+        if mode not in ("race", "merge"):
+            raise RuntimeError("SEARCH_MODE must be race or merge.")
+        self.engines = engines
+        self._mode = mode
+        self._deadline = deadline
+        self._fanout = fanout
+
+    @property
+    def name(self):
+        names = ",".join(e.name for e in self.engines)
+        return names if len(self.engines) == 1 else f"{names}:{self._mode}"
+
+    def _pick(self):
+        engines = sorted(
+            (e for e in self.engines if e.breaker.state != "open"), key=lambda e: e.score
+        )
+        if not engines:
+            raise SearchUnavailable("All the search engines are unavailable.")
+        return engines[:self._fanout] if self._fanout > 0 else engines
+
+    async def __call__(self, query: str):
+        engines = self._pick()
+        if len(engines) == 1:
+            return await engines[0].search(query)
+        tasks = {asyncio.create_task(e.search(query)): e for e in engines}
+        try:
+            if self._mode == "race":
+                return await self._race(tasks)
+            return await self._merge(tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def _race(self, tasks):
+        pending = set(tasks)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if task.exception() is not None:
+                    error = task.exception()
+                    logger.warning(f"Search engine {tasks[task].name} failed: {error}")
+                elif task.result():
+                    logger.info(f"Search engine {tasks[task].name} won the race.")
+                    return task.result()
+        if error is not None:
+            raise error
+        return []
+
+    async def _merge(self, tasks):
+        done, pending = await asyncio.wait(tasks, timeout=self._deadline)
+        if not any(t.exception() is None and t.result() for t in done) and pending:
+            # Nothing usable yet: take the next engine that answers.
+            return await self._race({t: tasks[t] for t in pending})
+        rankings = []
+        error = None
+        for task in done:
+            if task.exception() is not None:
+                error = task.exception()
+                logger.warning(f"Search engine {tasks[task].name} failed: {error}")
+            elif task.result():
+                rankings.append(task.result())
+        if not rankings:
+            if error is not None:
+                raise error
+            return []
+        if pending:
+            logger.info(
+                "Merging search results without "
+                + ",".join(tasks[t].name for t in pending)
+                + f", late by {self._deadline}s."
+            )
+        return fuse_rankings(rankings)[:REFERENCE_COUNT]
+
+
+def fuse_rankings(rankings):
+    """
+    Merges several ranked lists of contexts by reciprocal rank fusion. The
+    same page found by several engines is kept once, with the fields of the
+    engine that ranked it best.
+    """
+    scores = {}
+    contexts = {}
+    for ranking in rankings:
+        for rank, context in enumerate(ranking):
+            if not context.get("url"):
+                continue
+            key = canonical_url(context["url"])
+            scores[key] = scores.get(key, 0.0) + 1.0 / (SEARCH_RRF_K + rank + 1)
+            if key not in contexts or rank < contexts[key][0]:
+                contexts[key] = (rank, context)
+    return [contexts[key][1] for key in sorted(scores, key=lambda k: -scores[k])]
+
+
+def create_search_engine(_app, backend: str, retry_budget: RetryBudget) -> SearchEngine:
+    """
+    Creates the search engine for one BACKEND name.
+    """
+    if backend == "BING":
+        search_api_key = os.getenv("BING_SEARCH_V7_SUBSCRIPTION_KEY")
+        search_function = lambda query: search_with_bing(
+            _app.ctx.http_session,
+            query,
+            search_api_key,
+        )
+    elif backend == "GOOGLE":
+        search_api_key = os.getenv("GOOGLE_SEARCH_API_KEY")
+        search_function = lambda query: search_with_google(
+            _app.ctx.http_session,
+            query,
+            search_api_key,
+            os.getenv("GOOGLE_SEARCH_CX"),
+        )
+    elif backend == "SERPER":
+        search_api_key = os.getenv("SERPER_SEARCH_API_KEY")
+        search_function = lambda query: search_with_serper(
+            _app.ctx.http_session,
+            query,
+            search_api_key,
+        )
+    elif backend == "SERPAPI":
+        search_api_key = os.getenv("SERPAPI_API_KEY")
+        search_function = lambda query: search_with_serpapi(
+            _app.ctx.http_session,
+            query,
+            search_api_key,
+        )
+    elif backend == "SEARCH1API":
+        search1api_key = os.getenv("SEARCH1API_KEY")
+        search_function = lambda query: search_with_search1api(
+            _app.ctx.http_session,
+            query,
+            search1api_key,
+        )
+    elif backend == "SEARXNG":
+        logger.info(os.getenv("SEARXNG_BASE_URL"))
+        search_function = lambda query: search_with_searXNG(
+            _app.ctx.http_session,
+            query, 
+            os.getenv("SEARXNG_BASE_URL"),
+        )
+    else:
+        raise RuntimeError("Backend must be BING, GOOGLE, SERPER, SERPAPI, SEARCHAPI or SEARCH1API.")
+    return SearchEngine(backend, search_function, retry_budget)
+
+
+class LLMClientRegistry(object):
+    """
+    Long-lived LLM clients, one per provider, base URL and key, built once per
+    worker. They all share the pooled http client, so the connections to the
+    LLM endpoints are reused across requests.
+    """
+    def __init__(self, http_session: httpx.AsyncClient):
+        self._http_session = http_session
+        self._clients = {}
+
+    def get(self, provider: str, base_url: str = None, api_key: str = None):
+        key = (provider, base_url, api_key)
+        client = self._clients.get(key)
+        if client is None:
+            if provider == "anthropic":
+                client = AsyncAnthropic(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=self._http_session,
+                    # The router fails over instead of retrying.
+                    max_retries=0,
+                )
+            else:
+                client = AsyncOpenAI(
+                    api_key=api_key,
+                    base_url=base_url,
+                    http_client=self._http_session,
+                    max_retries=0,
+                )
+            self._clients[key] = client
+        return client
+
+    async def warm_up(self, timeout: float = LLM_WARM_UP_TIMEOUT):
+        """
+        Opens a connection to every endpoint, so that the first query does not
+        pay for the TCP+TLS handshake. Any HTTP response will do.
+        """
+        async def _warm_up(client):
+            try:
+                await self._http_session.head(str(client.base_url), timeout=timeout)
+            except Exception as e:
+                logger.warning(f"Could not warm up {client.base_url}: {e}")
 
+        await asyncio.gather(*[_warm_up(c) for c in self._clients.values()])
 
 
-def new_async_client(_app):
-    if "claude-3" in _app.ctx.model.lower():
-        return AsyncAnthropic(
-            api_key=os.getenv("ANTHROPIC_API_KEY")
+class LLMEndpoint(object):
+    """
+    One LLM endpoint, with its health: consecutive failures put it in a
+    cooldown that doubles every time, up to LLM_COOLDOWN_MAX seconds, and
+    losing a hedged race demotes it for LLM_SLOW_DEMOTION seconds.
+    """
+    def __init__(self, model: str, provider: str = None, base_url: str = None,
+                 api_key: str = None):
+        self.model = model
+        self.provider = provider or ("anthropic" if "claude-3" in model.lower() else "openai")
+        self.base_url = base_url
+        self.api_key = api_key
+        self.failures = 0
+        self.cooldown_until = 0
+        self.slow_until = 0
+        self.ttft = None
+
+    @property
+    def name(self):
+        return f"{self.provider}:{self.model}@{self.base_url or 'default'}"
+
+    @property
+    def healthy(self):
+        return time.monotonic() >= self.cooldown_until
+
+    @property
+    def slow(self):
+        return time.monotonic() < self.slow_until
+
+    def _sample(self, ttft: float):
+        # Exponentially weighted time to first token.
+        self.ttft = ttft if self.ttft is None else 0.8 * self.ttft + 0.2 * ttft
+
+    def record_success(self, ttft: float):
+        self.failures = 0
+        self.cooldown_until = 0
+        self.slow_until = 0
+        self._sample(ttft)
+
+    def record_slow(self, elapsed: float):
+        """ Records an attempt cancelled after `elapsed` seconds, as another one won. """
+        self.slow_until = time.monotonic() + LLM_SLOW_DEMOTION
+        self._sample(elapsed)
+
+    def record_failure(self):
+        self.failures += 1
+        self.cooldown_until = time.monotonic() + min(
+            LLM_COOLDOWN_MAX, LLM_COOLDOWN * 2 ** (self.failures - 1)
         )
-    else:
-        return AsyncOpenAI(
-            api_key=os.getenv("OPENAI_API_KEY") or os.getenv("GROQ_API_KEY"),
-            base_url=os.getenv("OPENAI_BASE_URL"),
-            http_client=_app.ctx.http_session,
+
+
+def load_llm_endpoints():
+    """
+    Reads the LLM endpoints, in order of preference. LLM_ENDPOINTS is a JSON
+    list of objects with a `model` and optionally a `provider` (openai or
+    anthropic), a `base_url` and an `api_key_env`, the name of the variable
+    holding the key. Without it, LLM_MODEL is the only endpoint.
+    """
+    if os.getenv("LLM_ENDPOINTS"):
+        return [
+            LLMEndpoint(
+                e["model"],
+                e.get("provider"),
+                e.get("base_url"),
+                os.getenv(e["api_key_env"]) if e.get("api_key_env") else e.get("api_key"),
+            )
+            for e in json.loads(os.getenv("LLM_ENDPOINTS"))
+        ]
+    model = os.getenv("LLM_MODEL")
+    if "claude-3" in model.lower():
+        return [LLMEndpoint(
+            model, "anthropic", os.getenv("ANTHROPIC_BASE_URL"), os.getenv("ANTHROPIC_API_KEY")
+        )]
+    return [LLMEndpoint(
+        model,
+        "openai",
+        os.getenv("OPENAI_BASE_URL"),
+        os.getenv("OPENAI_API_KEY") or os.getenv("GROQ_API_KEY"),
+    )]
+
+
+class LLMRouter(object):
+    """
+    Sends LLM calls to an ordered list of endpoints, healthy ones first.
+
+    A call that fails moves on to the next endpoint. A call that has not
+    produced its first result within LLM_HEDGE_DELAY seconds is hedged: the
+    same call is also sent to the next endpoint, and whichever answers first
+    wins while the other one is cancelled. An endpoint that was cancelled that
+    way is slow, it is tried after the fast ones until it is demoted no more,
+    so that not every call waits for the hedge delay and runs twice.
+    """
+    def __init__(self, endpoints, hedge_delay: float = LLM_HEDGE_DELAY):
+        self.endpoints = endpoints
+        self._hedge_delay = hedge_delay
+        self._cleanups = set()
+
+    def _candidates(self):
+        healthy = [e for e in self.endpoints if e.healthy]
+        return (
+            [e for e in healthy if not e.slow]
+            + sorted((e for e in healthy if e.slow), key=lambda e: e.ttft)
+            + [e for e in self.endpoints if not e.healthy]
         )
 
+    async def race(self, attempt, cleanup=None, hedge_delay: float = None):
+        """
+        Runs `attempt(endpoint)` and returns `(endpoint, result)` of the first
+        attempt to succeed. `cleanup(result)` releases the result of an
+        attempt that succeeded too late. `hedge_delay` overrides the hedge
+        delay of the router for this call.
+        """
+        if hedge_delay is None:
+            hedge_delay = self._hedge_delay
+        candidates = self._candidates()
+        attempts = {}
+        error = None
+
+        def _start():
+            endpoint = candidates.pop(0)
+            task = asyncio.create_task(attempt(endpoint))
+            attempts[task] = (endpoint, time.monotonic())
+            if len(attempts) > 1:
+                logger.info(f"Hedging the LLM call on {endpoint.name}.")
+
+        _start()
+        try:
+            while attempts:
+                timeout = hedge_delay if candidates and hedge_delay else None
+                done, _ = await asyncio.wait(
+                    attempts, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    _start()
+                    continue
+                winner = None
+                for task in done:
+                    endpoint, started = attempts.pop(task)
+                    if task.exception() is not None:
+                        error = task.exception()
+                        endpoint.record_failure()
+                        logger.warning(f"LLM endpoint {endpoint.name} failed: {error}")
+                    elif winner is None:
+                        endpoint.record_success(time.monotonic() - started)
+                        winner = endpoint, task.result()
+                    elif cleanup is not None:
+                        self._cleanup(cleanup(task.result()))
+                if winner is not None:
+                    # The attempts still running had no result within the
+                    # hedge delay and are about to be cancelled.
+                    for endpoint, started in attempts.values():
+                        elapsed = time.monotonic() - started
+                        if elapsed >= hedge_delay:
+                            logger.info(f"LLM endpoint {endpoint.name} lost after {elapsed:.1f}s.")
+                            endpoint.record_slow(elapsed)
+                    return winner
+                if candidates and not attempts:
+                    _start()
+            raise error
+        finally:
+            # Cancel the attempts that lost the race.
+            for task in attempts:
+                task.cancel()
+                if cleanup is not None:
+                    task.add_done_callback(
+                        lambda t: self._cleanup(cleanup(t.result()))
+                        if not t.cancelled() and t.exception() is None else None
+                    )
+
+    def _cleanup(self, coro):
+        task = asyncio.create_task(coro)
+        self._cleanups.add(task)
+        task.add_done_callback(self._cleanups.discard)
+
+
 @app.before_server_start
 async def server_init(_app):
     """
@@ -350,54 +2674,26 @@ async def server_init(_app):
     #         stream=True,
     #         timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
     #     )
-    if _app.ctx.backend == "BING":
-        _app.ctx.search_api_key = os.getenv("BING_SEARCH_V7_SUBSCRIPTION_KEY")
-        _app.ctx.search_function = lambda query: search_with_bing(
-            query,
-            _app.ctx.search_api_key,
-        )
-    elif _app.ctx.backend == "GOOGLE":
-        _app.ctx.search_api_key = os.getenv("GOOGLE_SEARCH_API_KEY")
-        _app.ctx.search_function = lambda query: search_with_google(
-            query,
-            _app.ctx.search_api_key,
-            os.getenv("GOOGLE_SEARCH_CX"),
-        )
-    elif _app.ctx.backend == "SERPER":
-        _app.ctx.search_api_key = os.getenv("SERPER_SEARCH_API_KEY")
-        _app.ctx.search_function = lambda query: search_with_serper(
-            query,
-            _app.ctx.search_api_key,
-        )
-    elif _app.ctx.backend == "SERPAPI":
-        _app.ctx.search_api_key = os.getenv("SERPAPI_API_KEY")
-        _app.ctx.search_function = lambda query: search_with_serpapi(
-            query,
-            _app.ctx.search_api_key,
-        )
-    elif _app.ctx.backend == "SEARCH1API":
-        _app.ctx.search1api_key = os.getenv("SEARCH1API_KEY")
-        _app.ctx.search_function = lambda query: search_with_search1api(
-            query,
-            _app.ctx.search1api_key,
-        )
-    elif _app.ctx.backend == "SEARXNG":
-        logger.info(os.getenv("SEARXNG_BASE_URL"))
-        _app.ctx.search_function = lambda query: search_with_searXNG(
-            query, 
-            os.getenv("SEARXNG_BASE_URL"),
-        )
-    else:
-        raise RuntimeError("Backend must be BING, GOOGLE, SERPER, SERPAPI, SEARCHAPI or SEARCH1API.")
-    _app.ctx.model = os.getenv("LLM_MODEL")
+    # BACKEND may list several engines, queried concurrently. They share
+    # one retry budget.
+    retry_budget = RetryBudget()
+    _app.ctx.search_function = MetaSearch(
+        [
+            create_search_engine(_app, b.strip(), retry_budget)
+            for b in _app.ctx.backend.split(",") if b.strip()
+        ]
+    )
+    # The cache key of the search results.
+    _app.ctx.backend = _app.ctx.search_function.name
+    _app.ctx.count_tokens = create_token_counter()
     _app.ctx.handler_max_concurrency = 16
-    # An executor to carry out async tasks, such as uploading to KV.
+    # The executor of the blocking KV calls and of the content cache.
     _app.ctx.executor = concurrent.futures.ThreadPoolExecutor(
         max_workers=_app.ctx.handler_max_concurrency * 2
     )
     # Create the KV to store the search results.
     logger.info("Creating KV. May take a while for the first time.")
-    _app.ctx.kv = KVWrapper(os.getenv("KV_NAME") or "search.db")
+    _app.ctx.kv = create_kv(_app.ctx.executor)
     # whether we should generate related questions.
     _app.ctx.should_do_related_questions = bool(
         os.getenv("RELATED_QUESTIONS") in ("1", "yes", "true")
@@ -405,10 +2701,108 @@ async def server_init(_app):
     _app.ctx.should_do_chat_history = bool(
         os.getenv("CHAT_HISTORY") in ("1", "yes", "true")
     )
-    # Create httpx Session
+    # Counters, stage latencies and queue depths of this worker, on /metrics.
+    _app.ctx.metrics = Metrics()
+    _app.ctx.server_timing = os.getenv("SERVER_TIMING") in ("1", "yes", "true")
+    # Cache the search results of repeated and trending queries.
+    _app.ctx.search_cache = SearchCache(
+        SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL, SEARCH_CACHE_STALE_TTL, _app.ctx.metrics
+    )
+    _app.ctx.related_cache = TTLCache(RELATED_CACHE_SIZE, RELATED_CACHE_TTL)
+    _app.ctx.semantic_cache = None
+    if os.getenv("SEMANTIC_CACHE") in ("1", "yes", "true"):
+        _app.ctx.semantic_cache = SemanticCache(
+            SEMANTIC_CACHE_SIZE, SEMANTIC_CACHE_TTL, SEMANTIC_CACHE_THRESHOLD
+        )
+    # In-flight generations by query, used to coalesce identical requests,
+    # and by search_uuid, used to attach late joiners.
+    _app.ctx.inflight_queries = {}
+    _app.ctx.inflight_uuids = {}
+    _app.ctx.background_tasks = set()
+    _app.ctx.metrics.gauge("executor_queue_depth", lambda: executor_queue_depth(_app.ctx.executor))
+    _app.ctx.metrics.gauge("inflight_generations", lambda: len(_app.ctx.inflight_queries))
+    _app.ctx.metrics.gauge("background_tasks", lambda: len(_app.ctx.background_tasks))
+    # Admission control of the stages, see ADMISSION_MAX_*.
+    _app.ctx.gates = {
+        name: AdmissionGate(
+            name, limit, ADMISSION_QUEUE_SIZE, ADMISSION_MAX_WAIT, _app.ctx.metrics
+        )
+        for name, limit in (
+            ("query", ADMISSION_MAX_QUERIES),
+            ("search", ADMISSION_MAX_SEARCHES),
+            ("llm", ADMISSION_MAX_LLM_STREAMS),
+            ("related", ADMISSION_MAX_RELATED),
+        )
+    }
+    for gate in _app.ctx.gates.values():
+        _app.ctx.metrics.gauge(f"admission_{gate.name}_active", lambda g=gate: g.active)
+        _app.ctx.metrics.gauge(f"admission_{gate.name}_waiting", lambda g=gate: g.waiting)
+    _app.ctx.workers = int(os.getenv("WORKERS") or 1)
+    # Create httpx Session. It is shared by the search engines and the LLM
+    # clients, so that connections are pooled and kept alive across queries.
     _app.ctx.http_session = httpx.AsyncClient(
         timeout=httpx.Timeout(connect=10, read=120, write=120, pool=10),
+        limits=httpx.Limits(
+            max_connections=HTTP_MAX_CONNECTIONS,
+            max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+        ),
+        http2=HTTP2_AVAILABLE,
     )
+    # Build the LLM clients once, and open their connections before the
+    # first query comes in.
+    _app.ctx.llm_clients = LLMClientRegistry(_app.ctx.http_session)
+    _app.ctx.llm_router = LLMRouter(load_llm_endpoints())
+    for endpoint in _app.ctx.llm_router.endpoints:
+        _app.ctx.llm_clients.get(endpoint.provider, endpoint.base_url, endpoint.api_key)
+    await _app.ctx.llm_clients.warm_up()
+    # Optionally enrich the search results with the full page content.
+    _app.ctx.content_enricher = None
+    if os.getenv("FULL_CONTENT") in ("1", "yes", "true"):
+        create_content_enricher(_app)
+
+
+def create_content_enricher(_app):
+    """
+    Creates the extraction pool, the content cache and the content enricher
+    of a worker. Needs the http session, the executor and the metrics.
+    """
+    # The extraction is CPU heavy, so it runs in its own pool.
+    _app.ctx.extraction_pool = create_extraction_pool(FULL_CONTENT_PROCESSES)
+    _app.ctx.content_cache = None
+    if CONTENT_CACHE_MAX_BYTES > 0:
+        _app.ctx.content_cache = ContentCache(
+            os.getenv("CONTENT_CACHE_NAME") or "content.db", CONTENT_CACHE_MAX_BYTES
+        )
+    _app.ctx.content_enricher = ContentEnricher(
+        _app.ctx.http_session,
+        _app.ctx.extraction_pool,
+        FULL_CONTENT_DEADLINE,
+        FULL_CONTENT_MAX_CONCURRENCY,
+        FULL_CONTENT_MAX_PER_HOST,
+        _app.ctx.content_cache,
+        _app.ctx.executor,
+        _app.ctx.metrics,
+    )
+    _app.ctx.metrics.gauge(
+        "extraction_queue_depth", lambda: executor_queue_depth(_app.ctx.extraction_pool)
+    )
+
+
+@app.after_server_stop
+async def server_shutdown(_app):
+    """
+    Releases the resources created in server_init.
+    """
+    await _app.ctx.http_session.aclose()
+    # Flush the writes that are still queued. The KV closes in the executor,
+    # so before it is shut down.
+    await _app.ctx.kv.aclose()
+    _app.ctx.executor.shutdown(wait=True)
+    if _app.ctx.content_enricher is not None:
+        _app.ctx.extraction_pool.shutdown(wait=False, cancel_futures=True)
+        if _app.ctx.content_cache is not None:
+            _app.ctx.content_cache.close()
 
 async def get_related_questions(_app, query, contexts):
     """
@@ -426,16 +2820,111 @@ async def get_related_questions(_app, query, contexts):
         context="\n\n".join([c["snippet"] for c in contexts])
     )
 
+    # The same query with the same contexts gets the same related questions.
+    cache_key = (
+        normalize_query(query),
+        hashlib.sha1("\x00".join(c["snippet"] for c in contexts).encode()).hexdigest(),
+    )
+    cached = _app.ctx.related_cache.get(cache_key)
+    if cached is not None:
+        _app.ctx.metrics.inc("cache_requests", layer="related", result="hit")
+        return cached[0]
+    _app.ctx.metrics.inc("cache_requests", layer="related", result="miss")
+
     try:
         logger.info('Start getting related questions')
-        if "claude-3" in _app.ctx.model.lower():
-            logger.info('Using Claude-3 model')
-            client = new_async_client(_app)
-            tools = [
-                {
+        start = time.monotonic()
+        # Waiting for a slot would delay the end of the stream, skip instead.
+        gate = _app.ctx.gates["related"]
+        await gate.acquire_nowait()
+        try:
+            _, related = await _app.ctx.llm_router.race(
+                lambda endpoint: _ask_related_questions(_app, endpoint, query, _more_questions_prompt),
+                hedge_delay=LLM_RELATED_HEDGE_DELAY,
+            )
+        finally:
+            gate.release()
+        _app.ctx.metrics.observe("stage_seconds", time.monotonic() - start, stage="related")
+        logger.info('Successfully got related questions')
+        if related and RELATED_CACHE_TTL > 0:
+            _app.ctx.related_cache.put(cache_key, related)
+        return related
+    except Overloaded as e:
+        # The related questions are optional, skip them under load.
+        logger.warning(f"{e} Skipping the related questions.")
+        return []
+    except Exception as e:
+        logger.error(
+            f"Encountered error while generating related questions: {str(e)}"
+        )
+        return []
+
+
+async def _ask_related_questions(_app, endpoint, query, _more_questions_prompt):
+    """
+    Asks one LLM endpoint for the related questions. Errors are raised, so that
+    the router can fail over to the next endpoint.
+    """
+    client = _app.ctx.llm_clients.get(endpoint.provider, endpoint.base_url, endpoint.api_key)
+    if endpoint.provider == "anthropic":
+        logger.info('Using Claude-3 model')
+        tools = [
+            {
+                "name": "ask_related_questions",
+                "description": "Get a list of questions related to the original question and context.",
+                "input_schema": {
+                    "type": "object",
+                    "properties": {
+                        "questions": {
+                            "type": "array",
+                            "items": {
+                                "type": "string",
+                                "description": "A related question to the original question and context.",
+                            }
+                        }
+                    },
+                    "required": ["questions"]
+                }
+                
+            }
+        ]
+        response = await client.beta.tools.messages.create(
+            model=endpoint.model,
+            system=_more_questions_prompt,
+            max_tokens=1000,
+            tools=tools,  
+            messages=[
+            {"role": "user", "content": query},
+        ]
+        )
+        logger.info('Response received from Claude-3 model')
+
+        if response.content and len(response.content) > 0:
+            related = []
+            for block in response.content:
+                if block.type == "tool_use" and block.name == "ask_related_questions":
+                    related = block.input["questions"]
+                    break
+        else:
+            related = []
+        
+        if related and isinstance(related, str):
+            try:
+                related = json.loads(related)
+            except json.JSONDecodeError:
+                logger.error("Failed to parse related questions as JSON")
+                return []
+        return [{"question": question} for question in related[:5]]
+    else:
+        logger.info('Using OpenAI model')
+        openai_client = client
+        tools = [
+            {
+                "type": "function",
+                "function": {
                     "name": "ask_related_questions",
                     "description": "Get a list of questions related to the original question and context.",
-                    "input_schema": {
+                    "parameters": {
                         "type": "object",
                         "properties": {
                             "questions": {
@@ -448,162 +2937,512 @@ async def get_related_questions(_app, query, contexts):
                         },
                         "required": ["questions"]
                     }
-                    
                 }
-            ]
-            response = await client.beta.tools.messages.create(
-                model=_app.ctx.model,
-                system=_more_questions_prompt,
-                max_tokens=1000,
-                tools=tools,  
-                messages=[
+            }
+        ]
+        messages=[
+                {"role": "system", "content": _more_questions_prompt},
                 {"role": "user", "content": query},
             ]
-            )
-            logger.info('Response received from Claude-3 model')
-
-            if response.content and len(response.content) > 0:
-                related = []
-                for block in response.content:
-                    if block.type == "tool_use" and block.name == "ask_related_questions":
-                        related = block.input["questions"]
-                        break
-            else:
-                related = []
+        request_body = {
+            "model": endpoint.model,
+            "messages": messages,
+            "max_tokens": 1000,
+            "tools": tools,
+            "tool_choice": {
+            "type": "function",
+            "function": {
+                "name": "ask_related_questions"
+            }
+            },        
+        }
+        llm_response = await openai_client.chat.completions.create(**request_body)
+        
+        if llm_response.choices and llm_response.choices[0].message:
+            message = llm_response.choices[0].message
             
-            if related and isinstance(related, str):
-                try:
+            if message.tool_calls:
+                related = message.tool_calls[0].function.arguments
+                if isinstance(related, str):
                     related = json.loads(related)
-                except json.JSONDecodeError:
-                    logger.error("Failed to parse related questions as JSON")
-                    return []
-            logger.info('Successfully got related questions')
-            return [{"question": question} for question in related[:5]] 
-        else:
-            logger.info('Using OpenAI model')
-            openai_client = new_async_client(_app)
-            tools = [
-                {
-                    "type": "function",
-                    "function": {
-                        "name": "ask_related_questions",
-                        "description": "Get a list of questions related to the original question and context.",
-                        "parameters": {
-                            "type": "object",
-                            "properties": {
-                                "questions": {
-                                    "type": "array",
-                                    "items": {
-                                        "type": "string",
-                                        "description": "A related question to the original question and context.",
-                                    }
-                                }
-                            },
-                            "required": ["questions"]
-                        }
-                    }
-                }
-            ]
-            messages=[
-                    {"role": "system", "content": _more_questions_prompt},
-                    {"role": "user", "content": query},
-                ]
-            request_body = {
-                "model": _app.ctx.model,
-                "messages": messages,
-                "max_tokens": 1000,
-                "tools": tools,
-                "tool_choice": {
-                "type": "function",
-                "function": {
-                    "name": "ask_related_questions"
-                }
-                },        
-            }
-            try:
-                llm_response = await openai_client.chat.completions.create(**request_body)
+                logger.trace(f"Related questions: {related}")
+                return [{"question": question} for question in related["questions"][:5]]
+            
+            elif message.content:
+                # 如果不存在 tool_calls 字段,但存在 content 字段,从 content 中提取相关问题
+                content = message.content
+                related_questions = content.split('\n')
+                related_questions = [q.strip() for q in related_questions if q.strip()]
                 
-                if llm_response.choices and llm_response.choices[0].message:
-                    message = llm_response.choices[0].message
-                    
-                    if message.tool_calls:
-                        related = message.tool_calls[0].function.arguments
-                        if isinstance(related, str):
-                            related = json.loads(related)
-                        logger.trace(f"Related questions: {related}")
-                        return [{"question": question} for question in related["questions"][:5]]
-                    
-                    elif message.content:
-                        # 如果不存在 tool_calls 字段,但存在 content 字段,从 content 中提取相关问题
-                        content = message.content
-                        related_questions = content.split('\n')
-                        related_questions = [q.strip() for q in related_questions if q.strip()]
+                # 提取带有序号的问题
+                cleaned_questions = []
+                for question in related_questions:
+                    if question.startswith('1.') or question.startswith('2.') or question.startswith('3.'):
+                        question = question[3:].strip()  # 去除问题编号和空格
                         
-                        # 提取带有序号的问题
-                        cleaned_questions = []
-                        for question in related_questions:
-                            if question.startswith('1.') or question.startswith('2.') or question.startswith('3.'):
-                                question = question[3:].strip()  # 去除问题编号和空格
-                                
-                                if question.startswith('"') and question.endswith('"'):
-                                    question = question[1:-1]  # 去除首尾的双引号
-                                elif question.startswith('"'):
-                                    question = question[1:]  # 去除开头的双引号
-                                elif question.endswith('"'):
-                                    question = question[:-1]  # 去除结尾的双引号
-                                
-                                cleaned_questions.append(question)
+                        if question.startswith('"') and question.endswith('"'):
+                            question = question[1:-1]  # 去除首尾的双引号
+                        elif question.startswith('"'):
+                            question = question[1:]  # 去除开头的双引号
+                        elif question.endswith('"'):
+                            question = question[:-1]  # 去除结尾的双引号
                         
-                        logger.trace(f"Related questions: {cleaned_questions}")
-                        return [{"question": question} for question in cleaned_questions[:5]]
+                        cleaned_questions.append(question)
                 
-            except Exception as e:
-                    logger.error(f"Error occurred while sending request to OpenAI model: {str(e)}")
-                    return []
-    except Exception as e:
-        logger.error(
-            f"Encountered error while generating related questions: {str(e)}"
-        )
+                logger.trace(f"Related questions: {cleaned_questions}")
+                return [{"question": question} for question in cleaned_questions[:5]]
         return []
-async def _raw_stream_response(
-    _app, contexts, llm_response, related_questions_future
+
+
+async def _stream_llm_answer(
+    _app, contexts, chat_history, query
+) -> AsyncGenerator[str, None]:
+    """
+    A generator that yields the text deltas of the answer, for both the Claude
+    and the OpenAI compatible providers, from the first LLM endpoint that
+    answers.
+    """
+    if _app.ctx.content_enricher is not None:
+        start = time.monotonic()
+        contexts = await _app.ctx.content_enricher.enrich(contexts)
+        _app.ctx.metrics.observe("stage_seconds", time.monotonic() - start, stage="extraction")
+    # Keep the prompt within its token budget. The citation numbers are the
+    # positions of the contexts sent to the client, even if some are left out.
+    count_tokens = _app.ctx.count_tokens
+    system_prompt = _rag_query_text.format(
+        context="\n\n".join(
+            [
+                f"[[citation:{number}]] {text}"
+                for number, text in pack_contexts(
+                    contexts, query, PROMPT_CONTEXT_TOKENS, count_tokens
+                )
+            ]
+        )
+    )
+    chat_history = trim_chat_history(chat_history, PROMPT_HISTORY_TOKENS, count_tokens)
+
+    async def _attempt(endpoint):
+        stream = _answer_stream(_app, endpoint, system_prompt, chat_history, query)
+        return stream, await anext(stream, None)
+
+    # The first endpoint to produce a token wins, see LLMRouter.
+    start = time.monotonic()
+    _, (stream, first_text) = await _app.ctx.llm_router.race(_attempt, _close_answer_stream)
+    _app.ctx.metrics.observe("stage_seconds", time.monotonic() - start, stage="llm_ttft")
+    if first_text is not None:
+        yield first_text
+        async for text in stream:
+            yield text
+    _app.ctx.metrics.observe("stage_seconds", time.monotonic() - start, stage="llm_total")
+
+
+async def _close_answer_stream(result):
+    stream, _ = result
+    await stream.aclose()
+
+
+async def _answer_stream(
+    _app, endpoint, system_prompt, chat_history, query
 ) -> AsyncGenerator[str, None]:
     """
-    A generator that yields the raw stream response. You do not need to call
-    this directly. Instead, use the stream_and_upload_to_kv which will also
-    upload the response to KV.
+    A generator that yields the text deltas of the answer from one endpoint.
+    """
+    client = _app.ctx.llm_clients.get(endpoint.provider, endpoint.base_url, endpoint.api_key)
+    if endpoint.provider == "anthropic":
+        logger.info("Using Claude for generating LLM response")
+        messages = []
+        if chat_history:
+            messages.extend(chat_history)  # 将历史记录添加到列表开头
+        # 然后添加当前查询消息
+        messages.append({"role": "user", "content": query})
+        async with client.messages.stream(
+            model=endpoint.model,
+            max_tokens=1024,
+            system=system_prompt,
+            messages=messages
+        ) as stream:
+            async for text in stream.text_stream:
+                yield text
+    else:
+        logger.info("Using OpenAI for generating LLM response")
+        messages=[
+                {"role": "system", "content": system_prompt},
+                {"role": "user", "content": query},
+            ]
+
+        if chat_history and len(chat_history) % 2 == 0:
+            # 将历史插入到消息中 index = 1 的位置
+            messages[1:1] = chat_history
+        llm_response = await client.chat.completions.create(
+            model=endpoint.model,
+            messages=messages,
+            max_tokens=1024,
+            stream=True,
+            temperature=0.9,
+        )
+        async for chunk in llm_response:
+            # The first and the last chunks carry no text.
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+async def _stream_events(
+    _app, contexts, first_text_task, llm_response, related_questions_task
+) -> AsyncGenerator[tuple, None]:
+    """
+    A generator that yields the events of the response, see StreamBroadcast.
+    `first_text_task` awaits the first delta of `llm_response`; it is already
+    running, so that the LLM connection is set up while the contexts are sent.
     """
     # First, yield the contexts.
-    yield json.dumps(contexts)
-    yield "\n\n__LLM_RESPONSE__\n\n"
+    yield "sources", contexts
     # Second, yield the llm response.
     if not contexts:
         # Prepend a warning to the user
-        yield (
+        yield "delta", (
             "(The search engine returned nothing for this query. Please take the"
             " answer with a grain of salt.)\n\n"
         )
-    
-    if "claude-3" in _app.ctx.model.lower():
-        # Process Claude's stream response
+    first_text = await first_text_task
+    if first_text is not None:
+        yield "delta", first_text
         async for text in llm_response:
-            yield text
-    else:
-        # Process OpenAI's stream response
-        async for chunk in llm_response:
-            if chunk.choices:
-                yield chunk.choices[0].delta.content or ""
-    # Third, yield the related questions. If any error happens, we will just
-    # return an empty list.
-    if related_questions_future is not None:
-        related_questions = await related_questions_future
+            yield "delta", text
+    # Third, yield the related questions. They have been generated at the same
+    # time as the answer, so usually they are ready by now. If any error
+    # happens, we will just return an empty list.
+    if related_questions_task is not None:
+        logger.info("About to send related questions.")
         try:
-            result = json.dumps(related_questions)
+            related_questions = await related_questions_task
         except Exception as e:
             logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
-            result = "[]"
-        yield "\n\n__RELATED_QUESTIONS__\n\n"
-        yield result
+            related_questions = []
+        yield "related", related_questions
+    yield "done", None
+
+
+async def _generate(
+    _app, broadcast, query, contexts, chat_history, generate_related_questions
+):
+    """
+    Runs one full generation - search, answer and related questions - and
+    publishes its events to `broadcast`. It runs as its own task,
+    so that several requests can share it.
+    """
+    first_text_task = None
+    related_questions_task = None
+    llm_gate = None
+    try:
+        if contexts is None:
+            start = time.monotonic()
+            # Only the searches that miss the cache take a search slot.
+            contexts = await _app.ctx.search_cache.search(
+                _app.ctx.backend, query, _app.ctx.gates["search"].wrap(_app.ctx.search_function)
+            )
+            broadcast.timings["search"] = time.monotonic() - start
+            _app.ctx.metrics.observe("stage_seconds", broadcast.timings["search"], stage="search")
+
+        # Hold an LLM stream slot until the answer is over. It is taken before
+        # the first event, so that a rejection can still be answered 429.
+        broadcast.timings["llm_queue"] = await _app.ctx.gates["llm"].acquire()
+        llm_gate = _app.ctx.gates["llm"]
+
+        # The answer and the related questions are two independent LLM calls,
+        # so start both of them at the same moment and only join them when
+        # the answer stream is over. The contexts are published before the
+        # first delta is awaited, so the browser renders the sources while the
+        # pages are enriched and the LLM connection is being set up.
+        llm_response = _count_answer_deltas(
+            broadcast, _stream_llm_answer(_app, contexts, chat_history, query)
+        )
+        first_text_task = asyncio.create_task(anext(llm_response, None))
+        if generate_related_questions:
+            related_questions_task = asyncio.create_task(
+                get_related_questions(_app, query, contexts)
+            )
+        async for event_type, data in _stream_events(
+            _app, contexts, first_text_task, llm_response, related_questions_task
+        ):
+            broadcast.publish(event_type, data)
+        logger.info("Finished streaming LLM response")
+        broadcast.close()
+        _app.ctx.metrics["llm_answers"] += 1
+        _app.ctx.metrics["llm_answer_deltas"] += broadcast.answer_deltas
+    except asyncio.CancelledError:
+        broadcast.close(RuntimeError("Generation cancelled."))
+        _record_cancelled_generation(_app, broadcast, related_questions_task)
+        raise
+    except Overloaded as e:
+        logger.warning(f"{e} Rejecting the generation of {query!r}.")
+        broadcast.close(e)
+    except Exception as e:
+        logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
+        broadcast.close(e)
+    finally:
+        if first_text_task is not None:
+            first_text_task.cancel()
+        if related_questions_task is not None:
+            related_questions_task.cancel()
+        if llm_gate is not None:
+            llm_gate.release()
+
+
+async def _count_answer_deltas(broadcast, llm_response):
+    async for text in llm_response:
+        broadcast.answer_deltas += 1
+        yield text
+
+
+def _record_cancelled_generation(_app, broadcast, related_questions_task):
+    """
+    Counts the work saved by cancelling a generation nobody reads anymore.
+    The tokens the answer would still have used are estimated from the
+    average length of the completed answers, one delta being about one token.
+    """
+    metrics = _app.ctx.metrics
+    metrics["generations_cancelled"] += 1
+    if metrics["llm_answers"]:
+        average = metrics["llm_answer_deltas"] / metrics["llm_answers"]
+        metrics["llm_tokens_saved"] += int(max(0, average - broadcast.answer_deltas))
+    if related_questions_task is not None and not related_questions_task.done():
+        metrics["related_questions_cancelled"] += 1
+    logger.info(
+        f"Generation cancelled after {broadcast.answer_deltas} deltas, nobody is reading it."
+    )
+
+
+async def _send_broadcast(request, broadcast, search_uuid=None, query=None):
+    """
+    Streams a broadcast to the client, replaying what has been generated so far
+    first. If `search_uuid` is given, the progress is also published to the KV
+    for other workers. Returns an error response if nothing could be sent.
+
+    If the client goes away, `request.ctx.disconnected` is set and the
+    subscription is closed right away, which cancels the generation when no
+    other client is reading it.
+    """
+    _app = request.app
+    stream_format = request.ctx.stream_format
+    request.ctx.disconnected = False
+    subscription = broadcast.subscribe()
+    next_event = None
+    last_partial_write = 0
+    published = False
+    try:
+        try:
+            # Only open the response once something can be sent, so that a
+            # failing search or LLM can still be reported as an error.
+            first_event = await anext(subscription)
+        except Overloaded:
+            return _overloaded_response()
+        except Exception:
+            return sanic.json({"message": "Internal server error."}, 503)
+        request.ctx.timings.update(broadcast.timings)
+        response = await request.respond(
+            content_type=STREAM_FORMATS[stream_format], headers=_server_timing(request)
+        )
+        writer = StreamWriter(response)
+        await writer.write(render_event(*first_event, stream_format))
+        ttfb = time.monotonic() - request.ctx.start_time
+        _app.ctx.metrics.observe("stage_seconds", ttfb, stage="ttfb")
+        logger.info(f"TTFB {ttfb * 1000:.0f} ms for {request.ctx.search_uuid}.")
+        failure = None
+        try:
+            while True:
+                if next_event is None:
+                    next_event = asyncio.create_task(anext(subscription, None))
+                # Wait for the next delta, but no longer than the buffered
+                # ones are allowed to wait.
+                done, _ = await asyncio.wait({next_event}, timeout=writer.flush_in())
+                if not done:
+                    await writer.flush()
+                    continue
+                event = next_event.result()
+                next_event = None
+                if event is None:
+                    break
+                await writer.write(render_event(*event, stream_format))
+                if search_uuid and time.monotonic() - last_partial_write > KV_PARTIAL_INTERVAL:
+                    last_partial_write = time.monotonic()
+                    _put_partial_result(_app, search_uuid, query, broadcast)
+            await writer.flush()
+        except Exception as e:
+            if broadcast.error is None:
+                # The generation is fine, so the client is gone.
+                logger.info(f"Client disconnected from {request.ctx.search_uuid}: {e!r}")
+                request.ctx.disconnected = True
+                return
+            logger.error(f"encountered error: {e}")
+            failure = str(e)
+            await writer.write(render_event("error", {"message": failure}, stream_format))
+            await writer.flush()
+        await response.eof()
+        if search_uuid:
+            _put_partial_result(_app, search_uuid, query, broadcast, failure)
+            published = True
+    except asyncio.CancelledError:
+        # Sanic cancels the handler when the connection is lost.
+        request.ctx.disconnected = True
+        raise
+    finally:
+        if next_event is not None and not next_event.done():
+            next_event.cancel()
+            await asyncio.wait({next_event})
+        await subscription.aclose()
+        if search_uuid and last_partial_write and not published:
+            # Left before the end: the followers must not wait for the rest.
+            _put_partial_result(_app, search_uuid, query, broadcast, "Generation abandoned.")
+
+
+async def _timed(request, stage: str, awaitable):
+    """
+    Awaits a stage of the request, adding its duration to the request timings
+    and the stage latency histogram.
+    """
+    start = time.monotonic()
+    try:
+        return await awaitable
+    finally:
+        elapsed = time.monotonic() - start
+        request.ctx.timings[stage] = request.ctx.timings.get(stage, 0) + elapsed
+        request.app.ctx.metrics.observe("stage_seconds", elapsed, stage=stage)
+
+
+def _server_timing(request) -> dict:
+    """
+    The Server-Timing header of the stages that are over, if SERVER_TIMING is
+    enabled. The response is streamed, so later stages cannot be reported.
+    """
+    if not request.app.ctx.server_timing:
+        return {}
+    timings = dict(request.ctx.timings, total=time.monotonic() - request.ctx.start_time)
+    return {
+        "Server-Timing": ", ".join(
+            f"{stage};dur={seconds * 1000:.1f}" for stage, seconds in timings.items()
+        )
+    }
+
+
+def _overloaded_response():
+    return sanic.json(
+        {"message": "Too many requests, please retry later."},
+        429,
+        headers={"Retry-After": str(ADMISSION_RETRY_AFTER)},
+    )
+
+
+def _stored_response(request, stored: str, layer: str = "kv"):
+    request.app.ctx.metrics.inc("cache_requests", layer=layer, result="hit")
+    return sanic.text(
+        stored,
+        content_type=STREAM_FORMATS[request.ctx.stream_format],
+        headers={"X-Cache": "HIT", **_server_timing(request)},
+    )
+
+
+def _store_result(_app, search_uuid, query, result):
+    """
+    Stores a result that was not generated for this search_uuid, in the
+    background, so that the link can be shared and followed up.
+    """
+    if _app.ctx.should_do_chat_history:
+        _spawn(_app, _app.ctx.kv.aappend_turn(search_uuid, {
+            "query": query,
+            "search_results": result["contexts"],
+            "llm_response": result["answer"].strip(),
+            "related_questions": result["related_questions"] or "",
+        }))
+    _spawn(_app, _app.ctx.kv.aput(search_uuid, {"query": query, **result}))
+
+
+def _put_partial_result(_app, search_uuid, query, broadcast, error: str = None):
+    """
+    Publishes the progress of a generation for the other workers. `error` is
+    set when the generation failed or was abandoned, its partial answer is
+    then never complete.
+    """
+    _spawn(_app, _app.ctx.kv.aput(
+        f"{search_uuid}_partial", {
+            "query": query,
+            **broadcast.result(),
+            "done": broadcast.done and error is None,
+            "error": error,
+            "updated": time.time(),
+        }, KV_PARTIAL_TTL
+    ))
+
+
+def _spawn(_app, coro):
+    """
+    Runs a coroutine in the background, keeping a reference to it until it is
+    done and logging its failure.
+    """
+    task = asyncio.create_task(coro)
+    _app.ctx.background_tasks.add(task)
+
+    def _done(t):
+        _app.ctx.background_tasks.discard(t)
+        if not t.cancelled() and t.exception() is not None:
+            logger.error(f"Background task failed: {t.exception()}")
+
+    task.add_done_callback(_done)
+    return task
+
+
+async def _follow_partial_result(request, search_uuid, query):
+    """
+    Follows a generation running in another worker by polling its partial
+    result in the KV. Returns False if there is no such generation, or if it
+    failed or was abandoned before anything was sent. If it stops afterwards,
+    an error event ends the response.
+    """
+    _app = request.app
+    partial_key = f"{search_uuid}_partial"
+    try:
+        partial = await _app.ctx.kv.aget(partial_key)
+    except Exception:
+        return False
+    if partial.get("query") != query or partial.get("error") or (
+        not partial["done"] and time.time() - partial["updated"] > KV_PARTIAL_STALE_AFTER
+    ):
+        return False
+    logger.info(f"Following the generation for {search_uuid} in another worker.")
+    stream_format = request.ctx.stream_format
+    response = await request.respond(content_type=STREAM_FORMATS[stream_format])
+    # What has been sent of the sources, the answer and the related questions.
+    sent = [False, 0, False]
+    while True:
+        frame = ""
+        if not sent[0] and partial.get("contexts") is not None:
+            frame += render_event("sources", partial["contexts"], stream_format)
+            sent[0] = True
+        answer = partial.get("answer") or ""
+        if sent[0] and len(answer) > sent[1]:
+            frame += render_event("delta", answer[sent[1]:], stream_format)
+            sent[1] = len(answer)
+        if not sent[2] and partial.get("related_questions") is not None:
+            frame += render_event("related", partial["related_questions"], stream_format)
+            sent[2] = True
+        if partial["done"]:
+            frame += render_event("done", None, stream_format)
+        elif partial.get("error"):
+            frame += render_event("error", {"message": partial["error"]}, stream_format)
+        elif time.time() - partial["updated"] > KV_PARTIAL_STALE_AFTER:
+            frame += render_event("error", {"message": "Generation stalled."}, stream_format)
+            partial["error"] = True
+        if frame:
+            await response.send(frame)
+        if partial["done"] or partial.get("error"):
+            break
+        await asyncio.sleep(KV_PARTIAL_INTERVAL)
+        try:
+            partial = await _app.ctx.kv.aget(partial_key)
+        except Exception as e:
+            await response.send(render_event("error", {"message": str(e)}, stream_format))
+            break
+    await response.eof()
+    return True
 
 
 def get_query_object(request):
@@ -634,18 +3473,35 @@ async def query_function(request: sanic.Request):
         - generate_related_questions: if set to false, will not generate related
             questions. Otherwise, will depend on the environment variable
             RELATED_QUESTIONS. Default: true.
+        - stream_format: "raw" (default), "ndjson" or "sse", see STREAM_FORMATS.
+            Also picked from the Accept header.
     """
     _app = request.app
+    request.ctx.start_time = time.monotonic()
+    request.ctx.timings = {}
     params = get_query_object(request)
+    request.ctx.stream_format = get_stream_format(request, params)
     query = params.get("query", None)
     search_uuid = params.get("search_uuid", None)
+    request.ctx.search_uuid = search_uuid
     generate_related_questions = params.get("generate_related_questions", True)
     if not query:
         raise HTTPException("query must be provided.")
+    # Basic attack protection: remove "[INST]" or "[/INST]" from the query
+    query = re.sub(r"\[/?INST\]", "", query)
+
+    # A shared link opened, or a page refreshed, while the answer is still
+    # being generated: attach to the generation instead of starting another.
+    inflight = _app.ctx.inflight_uuids.get(search_uuid) if search_uuid else None
+    if inflight is not None and inflight[0] == query:
+        logger.info(f"Attaching to the in-flight generation for {search_uuid}.")
+        _app.ctx.metrics.inc("cache_requests", layer="inflight", result="hit")
+        return await _stream_answer(request, inflight[1], search_uuid, query, inflight[2])
     
     # 定义传递给生成答案的聊天历史 以及搜索结果
     chat_history = []
     contexts = ""
+    result = None
     
     # Note that, if uuid exists, we don't check if the stored query is the same
     # as the current query, and simply return the stored result. This is to enable
@@ -655,12 +3511,8 @@ async def query_function(request: sanic.Request):
             # 开启了历史记录，读取历史记录
             history = []
             try:
-                history = await _app.loop.run_in_executor(
-                    _app.ctx.executor, lambda sid: _app.ctx.kv.get(sid), f"{search_uuid}_history"
-                )
-                result = await _app.loop.run_in_executor(
-                    _app.ctx.executor, lambda sid: _app.ctx.kv.get(sid), search_uuid
-                )
+                history = await _timed(request, "kv_read", _app.ctx.kv.aget_history(search_uuid))
+                result = await _timed(request, "kv_read", _app.ctx.kv.aget(search_uuid))
                 # return sanic.text(result)
             except KeyError:
                 logger.info(f"Key {search_uuid} not found, will generate again.")
@@ -685,18 +3537,21 @@ async def query_function(request: sanic.Request):
                             if "query" in entry and "llm_response" in entry:
                                 chat_history.append({"role": "user", "content": entry["query"]})
                                 chat_history.append({"role": "assistant", "content": entry["llm_response"]})
-                    else:
-                        return sanic.text(result["txt"]) # 查询未改变，直接返回结果
+                    elif isinstance(result, dict):
+                        # 查询未改变，直接返回结果
+                        return _stored_response(
+                            request, render_result(result, request.ctx.stream_format)
+                        )
         else:
             try:
-                result = await _app.loop.run_in_executor(
-                    _app.ctx.executor, lambda sid: _app.ctx.kv.get(sid), search_uuid
-                )
+                result = await _timed(request, "kv_read", _app.ctx.kv.aget(search_uuid))
                 # debug
                 if isinstance(result, dict):
                     # 只有相同的查询才返回同一个结果， 兼容多轮对话。
-                    if result["query"] == query:
-                        return sanic.text(result["txt"])
+                    if result.get("query") == query:
+                        return _stored_response(
+                            request, render_result(result, request.ctx.stream_format)
+                        )
                 else:
                     # TODO: 兼容旧数据代码 之后删除
                     # 旧数据强制刷新
@@ -720,132 +3575,167 @@ async def query_function(request: sanic.Request):
     #     )
     #     return StreamingResponse(content=result, media_type="text/html")
 
+    _app.ctx.metrics.inc("cache_requests", layer="kv", result="miss")
+    # The generation may be running in another worker.
+    if _app.ctx.workers > 1 and await _follow_partial_result(request, search_uuid, query):
+        return
+
     # First, do a search query.
     # query = query or _default_query
-    # Basic attack protection: remove "[INST]" or "[/INST]" from the query
-    query = re.sub(r"\[/?INST\]", "", query)
     # 开启聊天历史并且有有效数据 则不再重新请求搜索
     if not _app.ctx.should_do_chat_history or  contexts in ("", None):
-        contexts = await _app.loop.run_in_executor(
-            _app.ctx.executor, _app.ctx.search_function, query
-        )
+        contexts = None
+    generate_related_questions = bool(
+        _app.ctx.should_do_related_questions and generate_related_questions
+    )
 
-    system_prompt = _rag_query_text.format(
-        context="\n\n".join(
-            [f"[[citation:{i+1}]] {c['snippet']}" for i, c in enumerate(contexts)]
+    # A nearly identical query has been answered recently: reuse its answer.
+    # Follow-up questions depend on their own chat history, so they never do.
+    if _app.ctx.semantic_cache is not None and not chat_history:
+        cached = _app.ctx.semantic_cache.get(query)
+        if cached is not None and (
+            cached[0]["related_questions"] is not None or not generate_related_questions
+        ):
+            result, similarity = cached
+            if not generate_related_questions:
+                result = dict(result, related_questions=None)
+            logger.info(f"Semantic cache hit for {search_uuid} (similarity {similarity:.2f}).")
+            _store_result(_app, search_uuid, query, result)
+            return _stored_response(
+                request, render_result(result, request.ctx.stream_format), "semantic"
+            )
+        _app.ctx.metrics.inc("cache_requests", layer="semantic", result="miss")
+
+    return await _answer_query(
+        request, query, search_uuid, contexts, chat_history, generate_related_questions
+    )
+
+
+async def _start_generation(
+    request, coalesce_key, query, contexts, chat_history, generate_related_questions
+):
+    """
+    Admission control: a new generation waits for a query slot in a bounded
+    queue, and holds it until it is over. Raises Overloaded when the queue is
+    full, or when there is no room for one more answer stream, before
+    anything is searched. Requests joining a generation in progress do not
+    take a slot.
+    """
+    _app = request.app
+    gate = _app.ctx.gates["query"]
+    _app.ctx.gates["llm"].check()
+    request.ctx.timings["queue"] = await gate.acquire()
+    # The same generation may have been started while waiting.
+    broadcast = _app.ctx.inflight_queries.get(coalesce_key) if coalesce_key else None
+    if broadcast is not None:
+        gate.release()
+        return broadcast
+    broadcast = StreamBroadcast()
+    broadcast.task = asyncio.create_task(
+        _generate(
+            _app, broadcast, query, contexts, chat_history, generate_related_questions
         )
     )
-    try:
-        if _app.ctx.should_do_related_questions and generate_related_questions:
-            # While the answer is being generated, we can start generating
-            # related questions as a future.
-            related_questions_future = get_related_questions(_app, query, contexts)
-        if "claude-3" in _app.ctx.model.lower():
-            logger.info("Using Claude for generating LLM response")
-            client = new_async_client(_app)
-            messages=[
-                {"role": "user", "content": query},
-            ]
-            messages = []
-            if chat_history:
-                messages.extend(chat_history)  # 将历史记录添加到列表开头
-            # 然后添加当前查询消息
-            messages.append({"role": "user", "content": query})
-            response = await request.respond(content_type="text/html")
-            all_yielded_results = []
-
-            # First, yield the contexts.
-            logger.info("Sending initial context and LLM response marker.")
-            context_str = json.dumps(contexts)
-            await response.send(context_str)
-            all_yielded_results.append(context_str)
-            await response.send("\n\n__LLM_RESPONSE__\n\n")
-            all_yielded_results.append("\n\n__LLM_RESPONSE__\n\n")
-
-            # Second, yield the llm response.
-            if not contexts:
-                warning = "(The search engine returned nothing for this query. Please take the answer with a grain of salt.)\n\n"
-                await response.send(warning)
-                all_yielded_results.append(warning)
-            if related_questions_future is not None:
-                related_questions_task = asyncio.create_task(related_questions_future)
-            async with client.messages.stream(
-                model=_app.ctx.model,
-                max_tokens=1024,
-                system=system_prompt,
-                messages=messages
-            )as stream:
-                async for text in stream.text_stream:
-                    all_yielded_results.append(text)
-                    await response.send(text)
-
-            logger.info("Finished streaming LLM response")
-            # 在生成回复的同时异步等待相关问题任务完成
-            if related_questions_future is not None:
-                try:
-                    logger.info("About to send related questions.")
-                    related_questions = await related_questions_task
-                    logger.info("Related questions sent.")
-                    result = json.dumps(related_questions)
-                    await response.send("\n\n__RELATED_QUESTIONS__\n\n")
-                    all_yielded_results.append("\n\n__RELATED_QUESTIONS__\n\n")
-                    await response.send(result)
-                    all_yielded_results.append(result)
-                except Exception as e:
-                    logger.error(f"Error during related questions generation: {e}")
-            
-        else:
-            logger.info("Using OpenAI for generating LLM response")
-            openai_client = new_async_client(_app)
-            messages=[
-                    {"role": "system", "content": system_prompt},
-                    {"role": "user", "content": query},
-                ]
-
-            if chat_history and len(chat_history) % 2 == 0:
-                # 将历史插入到消息中 index = 1 的位置
-                messages[1:1] = chat_history
-            llm_response = await openai_client.chat.completions.create(
-                model=_app.ctx.model,
-                messages=messages,
-                max_tokens=1024,
-                stream=True,
-                temperature=0.9,
+    broadcast.task.add_done_callback(lambda _: gate.release())
+    if coalesce_key:
+        _app.ctx.inflight_queries[coalesce_key] = broadcast
+        broadcast.task.add_done_callback(
+            lambda _: _app.ctx.inflight_queries.pop(coalesce_key, None)
+        )
+    return broadcast
+
+
+async def _answer_query(
+    request, query, search_uuid, contexts, chat_history, generate_related_questions
+):
+    """
+    Generates the answer of a query, or joins the generation in progress,
+    streams it and stores it.
+    """
+    _app = request.app
+    # Concurrent requests for the same query share one search call and one
+    # LLM generation. Follow-up questions depend on their own chat history,
+    # so they are never shared.
+    coalesce_key = None
+    if not chat_history:
+        coalesce_key = (normalize_query(query), generate_related_questions)
+    broadcast = _app.ctx.inflight_queries.get(coalesce_key) if coalesce_key else None
+    if broadcast is None:
+        try:
+            broadcast = await _start_generation(
+                request, coalesce_key, query, contexts, chat_history, generate_related_questions
             )
-            response = await request.respond(content_type="text/html")
-            # First, stream and yield the results.
-            all_yielded_results = []
-            async for result in _raw_stream_response(
-                _app, contexts, llm_response, related_questions_future
-            ):
-                all_yielded_results.append(result)
-                await response.send(result)
-            logger.info("Finished streaming LLM response")            
+        except Overloaded as e:
+            logger.warning(f"{e} Rejecting {search_uuid}.")
+            return _overloaded_response()
+    else:
+        logger.info(f"Joining the in-flight generation for {coalesce_key}.")
+        _app.ctx.metrics.inc("cache_requests", layer="inflight", result="hit")
+    return await _stream_answer(request, broadcast, search_uuid, query, chat_history)
 
-    except Exception as e:
-        logger.error(f"encountered error: {e}\n{traceback.format_exc()}")
-        return sanic.json({"message": "Internal server error."}, 503)
-    # Second, upload to KV. Note that if uploading to KV fails, we will silently
-    # ignore it, because we don't want to affect the user experience.
-    await response.eof()
-    if _app.ctx.should_do_chat_history:
-        # 保存聊天历史
-        _search_results, _llm_response, _related_questions = await _app.loop.run_in_executor(
-            _app.ctx.executor, extract_all_sections, "".join(all_yielded_results)
-        )
-        if _search_results:
-            _search_results = json.loads(_search_results)
-        if _related_questions:
-            _related_questions = json.loads(_related_questions)
-        _ = _app.ctx.executor.submit(
-            _app.ctx.kv.append, f"{search_uuid}_history", {
+
+async def _stream_answer(request, broadcast, search_uuid, query, chat_history):
+    """
+    Streams a generation to the client and stores its result, once per
+    search_uuid. If the client goes away, the search_uuid stays attachable
+    until the generation ends, so that a refreshed page can attach to it again
+    and store it.
+    """
+    _app = request.app
+    _app.ctx.inflight_uuids[search_uuid] = (query, broadcast, chat_history)
+    try:
+        error = await _send_broadcast(
+            request, broadcast, search_uuid if _app.ctx.workers > 1 else None, query
+        )
+        if error is not None or broadcast.error is not None:
+            return error
+        if request.ctx.disconnected or search_uuid in broadcast.stored:
+            # Nobody received the answer, or it is stored already.
+            return
+        broadcast.stored.add(search_uuid)
+        # Second, upload to KV. Note that if uploading to KV fails, we will silently
+        # ignore it, because we don't want to affect the user experience.
+        # The answer was built up while streaming, no need to parse it back.
+        # With the SQLite KV, kv_write is the time to queue the write-behind
+        # writes, the writes themselves happen in its flusher thread.
+        result = broadcast.result()
+        if _app.ctx.should_do_chat_history:
+            # 保存聊天历史
+            await _timed(request, "kv_write", _app.ctx.kv.aappend_turn(search_uuid, {
                 "query": query,
-                "search_results": _search_results,
-                "llm_response": _llm_response,
-                "related_questions": _related_questions
-            })
-    _ = _app.ctx.executor.submit(
-        _app.ctx.kv.put, search_uuid, {"query": query, "txt": "".join(all_yielded_results)}  # 原来的缓存是直接根据sid返回结果，开启聊天历史后 同一个sid存储多轮对话，因此需要存储 query 兼容多轮对话
+                "search_results": result["contexts"],
+                "llm_response": result["answer"].strip(),
+                "related_questions": result["related_questions"] or "",
+            }))
+        # Late joiners are served from the registry until the KV has the result.
+        await _timed(request, "kv_write", _app.ctx.kv.aput(
+            search_uuid, {"query": query, **result}  # 原来的缓存是直接根据sid返回结果，开启聊天历史后 同一个sid存储多轮对话，因此需要存储 query 兼容多轮对话
+        ))
+        if _app.ctx.semantic_cache is not None and not chat_history and result["answer"]:
+            _app.ctx.semantic_cache.put(query, result)
+    except Exception as e:
+        logger.error(f"KV error: {e}")
+    finally:
+        if request.ctx.disconnected and not broadcast.task.done():
+            broadcast.task.add_done_callback(
+                lambda _: _forget_inflight_uuid(_app, search_uuid, broadcast)
+            )
+        else:
+            _forget_inflight_uuid(_app, search_uuid, broadcast)
+
+
+def _forget_inflight_uuid(_app, search_uuid, broadcast):
+    inflight = _app.ctx.inflight_uuids.get(search_uuid)
+    if inflight is not None and inflight[1] is broadcast:
+        del _app.ctx.inflight_uuids[search_uuid]
+
+@app.route("/metrics", methods=["GET"])
+async def metrics_function(request: sanic.Request):
+    """
+    The metrics of this worker, in the Prometheus text format.
+    """
+    return sanic.text(
+        request.app.ctx.metrics.render(), content_type="text/plain; version=0.0.4"
     )
 
 
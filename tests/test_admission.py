@@ -0,0 +1,21 @@
+import asyncio
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search4all import AdmissionGate, Overloaded  # noqa: E402
+
+
+def test_acquire_nowait_skips_when_full():
+    async def main():
+        gate = AdmissionGate("related", limit=1, max_waiting=8, max_wait=10)
+        await gate.acquire_nowait()
+        with pytest.raises(Overloaded):
+            await asyncio.wait_for(gate.acquire_nowait(), 0.1)
+        gate.release()
+        await gate.acquire_nowait()
+        assert gate.active == 1
+
+    asyncio.run(main())
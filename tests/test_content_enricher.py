@@ -0,0 +1,121 @@
+"""
+The content enricher as the server builds it, inside a daemon process like
+the Sanic workers.
+"""
+import asyncio
+import concurrent.futures
+import multiprocessing
+import os
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+
+import httpx
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import search4all  # noqa: E402
+
+PARAGRAPH = (
+    "The river city grew around its harbour in the nineteenth century, when "
+    "merchants built warehouses along the quays and the first railway reached "
+    "the old town. "
+)
+PAGE = (
+    "<html><head><title>River city</title></head><body><article><h1>River city</h1>"
+    + "".join(f"<p>{PARAGRAPH * 3} Paragraph {i}.</p>" for i in range(8))
+    + "</article></body></html>"
+).encode()
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/html; charset=utf-8")
+        self.send_header("Content-Length", str(len(PAGE)))
+        self.end_headers()
+        self.wfile.write(PAGE)
+
+    def log_message(self, *args):
+        pass
+
+
+async def _enrich(url):
+    _app = SimpleNamespace(ctx=SimpleNamespace(
+        http_session=httpx.AsyncClient(),
+        executor=concurrent.futures.ThreadPoolExecutor(max_workers=2),
+        metrics=search4all.Metrics(),
+    ))
+    search4all.create_content_enricher(_app)
+    try:
+        enriched = await _app.ctx.content_enricher.enrich(
+            [{"name": "River city", "url": url, "snippet": "A snippet."}]
+        )
+        return enriched[0].get("content")
+    finally:
+        await _app.ctx.http_session.aclose()
+        _app.ctx.extraction_pool.shutdown()
+        _app.ctx.content_cache.close()
+
+
+def _worker(url, results):
+    try:
+        results.put(asyncio.run(_enrich(url)))
+    except Exception as e:
+        results.put(e)
+
+
+def test_enrich_in_a_daemon_worker(tmp_path, monkeypatch):
+    monkeypatch.setenv("CONTENT_CACHE_NAME", str(tmp_path / "content.db"))
+    server = ThreadingHTTPServer(("127.0.0.1", 0), PageHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    try:
+        context = multiprocessing.get_context("fork")
+        results = context.Queue()
+        worker = context.Process(
+            target=_worker,
+            args=(f"http://127.0.0.1:{server.server_address[1]}/river-city", results),
+            daemon=True,
+        )
+        worker.start()
+        content = results.get(timeout=30)
+        worker.join()
+    finally:
+        server.shutdown()
+    assert not isinstance(content, Exception), content
+    assert content and "warehouses along the quays" in content
+
+
+def _read_html(headers, body):
+    """ Reads a page through ContentEnricher._read_html, returning the bytes it pulled too. """
+    sent = []
+
+    async def chunks():
+        for i in range(0, len(body), 1024):
+            sent.append(len(body[i:i + 1024]))
+            yield body[i:i + 1024]
+
+    async def main():
+        transport = httpx.MockTransport(
+            lambda request: httpx.Response(200, headers=headers, content=chunks())
+        )
+        async with httpx.AsyncClient(transport=transport) as client:
+            async with client.stream("GET", "http://example.com/") as response:
+                return await search4all.ContentEnricher._read_html(response)
+
+    return asyncio.run(main()), sum(sent)
+
+
+def test_pages_are_rejected_on_their_headers(monkeypatch):
+    monkeypatch.setattr(search4all, "FULL_CONTENT_MAX_BYTES", 4096)
+    html, read = _read_html({"content-type": "application/pdf"}, b"%PDF" * 4096)
+    assert html is None and read == 0
+    html, read = _read_html({"content-type": "text/html", "content-length": "16384"}, b"<p>" * 4096)
+    assert html is None and read == 0
+
+
+def test_page_download_is_capped(monkeypatch):
+    monkeypatch.setattr(search4all, "FULL_CONTENT_MAX_BYTES", 4096)
+    html, read = _read_html({"content-type": "text/html; charset=utf-8"}, b"<p>x</p>" * 4096)
+    assert html == ("<p>x</p>" * 512)
+    assert read < 8 * 4096
@@ -0,0 +1,131 @@
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import search4all  # noqa: E402
+from search4all import KVWrapper, LMDBKV  # noqa: E402
+
+
+@pytest.fixture
+def kv(tmp_path):
+    kv = KVWrapper(str(tmp_path / "search.db"), flush_interval=60)
+    yield kv
+    kv.close()
+
+
+def test_value_that_cannot_be_encoded_is_dropped(kv):
+    kv.put("bad", lambda: None)
+    kv.put("good", {"answer": "42"})
+    kv.append_turn("sid", {"query": "q", "search_results": [{"url": object()}]})
+    kv.append_turn("sid", {"query": "q2", "llm_response": "a2"})
+    kv.flush()
+    with pytest.raises(KeyError):
+        kv.get("bad")
+    assert kv.get("good") == {"answer": "42"}
+    assert [t["query"] for t in kv.get_history("sid")] == ["q2"]
+    assert kv._flusher.is_alive()
+
+
+def test_legacy_history_comes_before_new_turns(kv):
+    legacy = [{"query": "q1", "search_results": None, "llm_response": "a1", "related_questions": None}]
+    kv.put("sid_history", legacy)
+    kv.flush()
+    kv.append_turn("sid", {"query": "q2", "llm_response": "a2"})
+    assert [t["query"] for t in kv.get_history("sid")] == ["q1", "q2"]
+    kv.flush()
+    kv.append_turn("sid", {"query": "q3", "llm_response": "a3"})
+    assert [t["query"] for t in kv.get_history("sid")] == ["q1", "q2", "q3"]
+    assert [t["query"] for t in kv.get_history("sid", limit=2)] == ["q2", "q3"]
+
+
+def test_flushed_turns_are_not_read_twice(kv):
+    seen = []
+
+    class CommitSpy(object):
+        """ Reads the history from another thread right after each commit. """
+        def __init__(self, db):
+            self._db = db
+
+        def __getattr__(self, name):
+            return getattr(self._db, name)
+
+        def __enter__(self):
+            return self._db.__enter__()
+
+        def __exit__(self, *exc_info):
+            return self._db.__exit__(*exc_info)
+
+        def commit(self):
+            self._db.commit()
+            reader = threading.Thread(
+                target=lambda: seen.append([t["query"] for t in kv.get_history("sid")])
+            )
+            reader.start()
+            readers.append(reader)
+            reader.join(0.2)
+
+    readers = []
+    kv.append_turn("sid", {"query": "q1", "llm_response": "a1"})
+    kv._db = CommitSpy(kv._db)
+    kv.flush()
+    for reader in readers:
+        reader.join()
+    assert seen == [["q1"]]
+    assert [t["query"] for t in kv.get_history("sid")] == ["q1"]
+
+
+def test_eviction_takes_the_chat_history_along(tmp_path):
+    kv = KVWrapper(str(tmp_path / "search.db"), flush_interval=60, max_bytes=3000)
+    try:
+        for i in range(10):
+            sid = f"sid{i}"
+            kv.put(sid, {"query": "q", "answer": os.urandom(600).hex()})
+            kv.append_turn(sid, {"query": "q", "search_results": [{"i": i}], "llm_response": "a"})
+            kv.flush()
+        kv.compact()
+        kept = [f"sid{i}" for i in range(10) if kv.get_history(f"sid{i}")]
+        assert kept and len(kept) < 10
+        for i in range(10):
+            sid = f"sid{i}"
+            if sid in kept:
+                assert kv.get(sid)["query"] == "q"
+            else:
+                with pytest.raises(KeyError):
+                    kv.get(sid)
+        results = kv._db.execute("SELECT COUNT(*) FROM history_results").fetchone()[0]
+        assert results == len(kept)
+    finally:
+        kv.close()
+
+
+def test_lmdb_compaction_deletes_expired_and_orphaned(tmp_path, monkeypatch):
+    pytest.importorskip("lmdb")
+    monkeypatch.setattr(search4all, "KV_LMDB_ORPHAN_GRACE", 0)
+    kv = LMDBKV(str(tmp_path / "search.lmdb"), map_size=1 << 24)
+    try:
+        kv.put("kept", {"query": "q"})
+        kv.append_turn("kept", {"query": "q", "search_results": [{"i": 1}], "llm_response": "a"})
+        kv.put("gone_partial", {"query": "q"}, ttl=0.01)
+        kv.put("gone", {"query": "q"}, ttl=0.01)
+        kv.append_turn("gone", {"query": "q", "search_results": [{"i": 2}], "llm_response": "a"})
+        time.sleep(0.05)
+        kv.compact()
+        with kv._env.begin() as txn:
+            assert txn.stat(kv._kv)["entries"] == 1
+            assert txn.stat(kv._turns)["entries"] == 2
+            assert txn.stat(kv._results)["entries"] == 1
+        assert kv.get_history("kept")[0]["search_results"] == [{"i": 1}]
+        assert kv.get_history("gone") == []
+    finally:
+        kv.close()
+
+
+def test_lmdb_rejects_max_bytes(tmp_path, monkeypatch):
+    pytest.importorskip("lmdb")
+    monkeypatch.setattr(search4all, "KV_MAX_BYTES", 1 << 20)
+    with pytest.raises(RuntimeError):
+        LMDBKV(str(tmp_path / "search.lmdb"))
@@ -0,0 +1,43 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search4all import LLMEndpoint, LLMRouter  # noqa: E402
+
+
+def test_slow_endpoint_is_demoted():
+    slow, fast = LLMEndpoint("gpt-slow"), LLMEndpoint("gpt-fast")
+    router = LLMRouter([slow, fast], hedge_delay=0.05)
+    calls = []
+
+    async def attempt(endpoint):
+        calls.append(endpoint.model)
+        await asyncio.sleep(1 if endpoint is slow else 0.01)
+        return endpoint.model
+
+    async def main():
+        first = await router.race(attempt)
+        second = await router.race(attempt)
+        return first, second
+
+    first, second = asyncio.run(main())
+    assert first == (fast, "gpt-fast")
+    assert second == (fast, "gpt-fast")
+    # The second call was not hedged: the slow endpoint is tried last.
+    assert calls == ["gpt-slow", "gpt-fast", "gpt-fast"]
+    assert slow.slow and not fast.slow
+
+
+def test_hedge_delay_per_call():
+    slow, fast = LLMEndpoint("gpt-slow"), LLMEndpoint("gpt-fast")
+    router = LLMRouter([slow, fast], hedge_delay=0.01)
+    calls = []
+
+    async def attempt(endpoint):
+        calls.append(endpoint.model)
+        await asyncio.sleep(0.1)
+        return endpoint.model
+
+    assert asyncio.run(router.race(attempt, hedge_delay=1)) == (slow, "gpt-slow")
+    assert calls == ["gpt-slow"]
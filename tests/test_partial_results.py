@@ -0,0 +1,70 @@
+import asyncio
+import os
+import sys
+import time
+from types import SimpleNamespace
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import search4all  # noqa: E402
+from search4all import _follow_partial_result  # noqa: E402
+
+
+class PartialKV(object):
+    """ Returns the partials in turn, the last one forever. """
+    def __init__(self, *partials):
+        self.partials = list(partials)
+
+    async def aget(self, key):
+        if len(self.partials) > 1:
+            return self.partials.pop(0)
+        return self.partials[0]
+
+
+class Response(object):
+    def __init__(self):
+        self.frames = []
+
+    async def send(self, frame):
+        self.frames.append(frame)
+
+    async def eof(self):
+        pass
+
+
+def make_request(kv):
+    response = Response()
+
+    async def respond(**kwargs):
+        return response
+
+    request = SimpleNamespace(
+        app=SimpleNamespace(ctx=SimpleNamespace(kv=kv)),
+        ctx=SimpleNamespace(stream_format="ndjson"),
+        respond=respond,
+    )
+    return request, response
+
+
+def partial(answer, done=False, error=None):
+    return {
+        "query": "q", "contexts": [], "answer": answer, "related_questions": None,
+        "done": done, "error": error, "updated": time.time(),
+    }
+
+
+def test_failed_partial_is_regenerated():
+    request, response = make_request(PartialKV(partial("word0 ", error="Generation abandoned.")))
+    assert not asyncio.run(_follow_partial_result(request, "u", "q"))
+    assert response.frames == []
+
+
+def test_abandoned_partial_ends_with_error(monkeypatch):
+    monkeypatch.setattr(search4all, "KV_PARTIAL_INTERVAL", 0)
+    request, response = make_request(PartialKV(
+        partial("word0 "), partial("word0 word1 ", error="Generation abandoned.")
+    ))
+    assert asyncio.run(_follow_partial_result(request, "u", "q"))
+    body = "".join(response.frames)
+    assert '"word1 "' in body
+    assert '"type": "error"' in body
+    assert '"type": "done"' not in body
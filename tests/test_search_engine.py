@@ -0,0 +1,63 @@
+import asyncio
+import os
+import sys
+
+import httpx
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search4all import (  # noqa: E402
+    SEARCH_RETRIES, SearchCache, SearchEngine, SearchEngineError, SearchUnavailable,
+)
+
+
+def failing_engine(error):
+    calls = []
+
+    async def search_function(query):
+        calls.append(query)
+        raise error
+
+    return SearchEngine("fake", search_function), calls
+
+
+@pytest.mark.parametrize("error", [
+    SearchEngineError(401), SearchEngineError(403), SearchEngineError(400), ValueError("bad json"),
+])
+def test_non_retryable_errors_fail_fast(error):
+    engine, calls = failing_engine(error)
+    with pytest.raises(type(error)):
+        asyncio.run(engine.search("query"))
+    assert len(calls) == 1
+    assert engine.breaker.failures == 0
+
+
+@pytest.mark.parametrize("error", [
+    SearchEngineError(503), SearchEngineError(429), httpx.ConnectError("refused"),
+])
+def test_retryable_errors_are_retried(error):
+    engine, calls = failing_engine(error)
+    with pytest.raises(type(error)):
+        asyncio.run(engine.search("query"))
+    assert len(calls) == SEARCH_RETRIES + 1
+    assert engine.breaker.failures == SEARCH_RETRIES + 1
+
+
+def test_cause_is_classified():
+    try:
+        raise SearchEngineError() from httpx.ReadTimeout("slow")
+    except SearchEngineError as e:
+        error = e
+    engine, calls = failing_engine(error)
+    with pytest.raises(SearchEngineError):
+        asyncio.run(engine.search("query"))
+    assert len(calls) == SEARCH_RETRIES + 1
+
+
+@pytest.mark.parametrize("ttl", [0, 600])
+def test_unavailable_search_answers_without_sources(ttl):
+    async def search_function(query):
+        raise SearchUnavailable("Every search backend is unavailable.")
+
+    cache = SearchCache(maxsize=16, ttl=ttl, stale_ttl=0)
+    assert asyncio.run(cache.search("fake", "query", search_function)) == []
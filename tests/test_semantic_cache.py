@@ -0,0 +1,41 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search4all import SEMANTIC_CACHE_THRESHOLD, SemanticCache  # noqa: E402
+
+
+@pytest.mark.parametrize("stored, query", [
+    ("ibuprofen with alcohol", "ibuprofen without alcohol"),
+    ("celsius to fahrenheit", "fahrenheit to celsius"),
+    ("capital of Niger", "capital of Nigeria"),
+    ("flights from paris to london", "flights from london to paris"),
+    ("iphone 14 battery life", "iphone 15 battery life"),
+])
+def test_different_questions_do_not_match(stored, query):
+    cache = SemanticCache(16, 3600, SEMANTIC_CACHE_THRESHOLD)
+    cache.put(stored, {"answer": stored})
+    assert cache.get(query) is None
+
+
+@pytest.mark.parametrize("stored, query", [
+    ("Who is the president of the United States", "who is president of the united states?"),
+    ("capital of France", "Capital of France!"),
+])
+def test_same_questions_match(stored, query):
+    cache = SemanticCache(16, 3600, SEMANTIC_CACHE_THRESHOLD)
+    cache.put(stored, {"answer": stored})
+    value, similarity = cache.get(query)
+    assert value == {"answer": stored}
+    assert similarity >= SEMANTIC_CACHE_THRESHOLD
+
+
+def test_eviction_forgets_the_entry():
+    cache = SemanticCache(1, 3600, SEMANTIC_CACHE_THRESHOLD)
+    cache.put("capital of France", 1)
+    cache.put("capital of Spain", 2)
+    assert len(cache) == 1
+    assert cache.get("capital of France") is None
+    assert cache.get("capital of Spain")[0] == 2
@@ -0,0 +1,51 @@
+import asyncio
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import search4all  # noqa: E402
+from search4all import StreamBroadcast  # noqa: E402
+
+
+async def generate(broadcast, deltas):
+    for i in range(deltas):
+        broadcast.publish("delta", f"word{i} ")
+        await asyncio.sleep(0.01)
+    broadcast.close()
+
+
+async def read_one(broadcast):
+    subscription = broadcast.subscribe()
+    event = await anext(subscription)
+    await subscription.aclose()
+    return event
+
+
+def test_resubscribe_within_grace_period(monkeypatch):
+    monkeypatch.setattr(search4all, "STREAM_GRACE_PERIOD", 0.2)
+
+    async def main():
+        broadcast = StreamBroadcast()
+        broadcast.task = asyncio.create_task(generate(broadcast, 30))
+        await read_one(broadcast)
+        await asyncio.sleep(0.1)
+        events = [event async for event in broadcast.subscribe()]
+        await broadcast.task
+        return events
+
+    events = asyncio.run(main())
+    assert len(events) == 30
+
+
+def test_unobserved_generation_is_cancelled(monkeypatch):
+    monkeypatch.setattr(search4all, "STREAM_GRACE_PERIOD", 0.05)
+
+    async def main():
+        broadcast = StreamBroadcast()
+        broadcast.task = asyncio.create_task(generate(broadcast, 100))
+        await read_one(broadcast)
+        await asyncio.sleep(0.2)
+        return broadcast.task
+
+    task = asyncio.run(main())
+    assert task.cancelled()
@@ -0,0 +1,40 @@
+import json
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from search4all import STREAM_FORMATS, render_event, render_result  # noqa: E402
+
+
+@pytest.mark.parametrize("stream_format", list(STREAM_FORMATS))
+def test_error_event_is_visible(stream_format):
+    rendered = render_event("error", {"message": "LLM failed"}, stream_format)
+    assert "LLM failed" in rendered
+
+
+def test_raw_error_marker():
+    rendered = render_event("delta", "Partial answer", "raw") + render_event(
+        "error", {"message": "LLM failed"}, "raw"
+    )
+    answer, error = rendered.split("\n\n__ERROR__\n\n")
+    assert answer == "Partial answer"
+    assert json.loads(error) == {"message": "LLM failed"}
+
+
+@pytest.mark.parametrize("stream_format", list(STREAM_FORMATS))
+def test_legacy_result_is_rendered(stream_format):
+    txt = (
+        json.dumps([{"name": "Source"}]) + "\n\n__LLM_RESPONSE__\n\n" + "The answer."
+        + "\n\n__RELATED_QUESTIONS__\n\n" + json.dumps([{"question": "Why?"}])
+    )
+    rendered = render_result({"query": "q", "txt": txt}, stream_format)
+    if stream_format == "raw":
+        assert rendered == txt
+    else:
+        assert "The answer." in rendered
+        assert "Source" in rendered and "Why?" in rendered
+    if stream_format == "ndjson":
+        types = [json.loads(line)["type"] for line in rendered.splitlines()]
+        assert types == ["sources", "delta", "related", "done"]
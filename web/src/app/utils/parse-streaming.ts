@@ -2,8 +2,13 @@ import { Relate } from "@/app/interfaces/relate";
 import { Source } from "@/app/interfaces/source";
 import { fetchStream } from "@/app/utils/fetch-stream";
 
-const LLM_SPLIT = "__LLM_RESPONSE__";
-const RELATED_SPLIT = "__RELATED_QUESTIONS__";
+// One typed event per line, see STREAM_FORMATS in search4all.py.
+type StreamEvent =
+  | { type: "sources"; data: Source[] }
+  | { type: "delta"; data: string }
+  | { type: "related"; data: Relate[] }
+  | { type: "done"; data: null }
+  | { type: "error"; data: { message: string } };
 
 export const parseStreaming = async (
   controller: AbortController,
@@ -16,20 +21,22 @@ export const parseStreaming = async (
   onError?: (status: number) => void,
 ) => {
   const decoder = new TextDecoder();
-  let uint8Array = new Uint8Array();
-  let chunks = "";
-  let sourcesEmitted = false;
+  // The incomplete last line of what has been received so far.
+  let pending = "";
+  let markdown = "";
+  let relatesEmitted = false;
   const response = await fetch(`/query`, {
     method: "POST",
     headers: {
       "Content-Type": "application/json",
-      Accept: "*./*",
+      Accept: "application/x-ndjson",
     },
     signal: controller.signal,
     body: JSON.stringify({
       query,
       search_uuid,
       lang,
+      stream_format: "ndjson",
     }),
   });
   if (response.status !== 200) {
@@ -45,34 +52,46 @@ export const parseStreaming = async (
         .replace(/\[[cC]itation:(\d+)]/g, "[citation]($1)"),
     );
   };
+  const onEvent = (event: StreamEvent) => {
+    switch (event.type) {
+      case "sources":
+        onSources(event.data || []);
+        break;
+      case "delta":
+        if (!event.data) break;
+        markdown += event.data;
+        markdownParse(markdown);
+        break;
+      case "related":
+        onRelates(event.data || []);
+        relatesEmitted = true;
+        break;
+      case "error":
+        // The stream has started, so the status is 200: report a server error.
+        onError?.(500);
+        break;
+    }
+  };
+  const onLines = (text: string) => {
+    // Only the new text is split; a line cut across two chunks waits in
+    // `pending` for the rest.
+    const lines = (pending + text).split("\n");
+    pending = lines.pop() || "";
+    for (const line of lines) {
+      if (!line) continue;
+      try {
+        onEvent(JSON.parse(line));
+      } catch (e) {}
+    }
+  };
   fetchStream(
     response,
     (chunk) => {
-      uint8Array = new Uint8Array([...uint8Array, ...chunk]);
-      chunks = decoder.decode(uint8Array, { stream: true });
-      if (chunks.includes(LLM_SPLIT)) {
-        const [sources, rest] = chunks.split(LLM_SPLIT);
-        if (!sourcesEmitted) {
-          try {
-            onSources(JSON.parse(sources));
-          } catch (e) {
-            onSources([]);
-          }
-        }
-        sourcesEmitted = true;
-        if (rest.includes(RELATED_SPLIT)) {
-          const [md] = rest.split(RELATED_SPLIT);
-          markdownParse(md);
-        } else {
-          markdownParse(rest);
-        }
-      }
+      onLines(decoder.decode(chunk, { stream: true }));
     },
     () => {
-      const [_, relates] = chunks.split(RELATED_SPLIT);
-      try {
-        onRelates(JSON.parse(relates));
-      } catch (e) {
+      onLines(decoder.decode() + "\n");
+      if (!relatesEmitted) {
         onRelates([]);
       }
     },